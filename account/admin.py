@@ -1,6 +1,6 @@
 from django.contrib import admin
-from account.models import Account, Order, Trade, Balance
-from account.tasks import fetch_orders, fetch_trades
+from account.models import Account, Order, Trade, Balance, BalanceRollup, SyncCursor
+from account.tasks import fetch_orders, fetch_trades, backfill_rollups
 from pnl.tasks import update_asset_inventory, update_contract_inventory
 from django.db.models import JSONField
 from prettyjson import PrettyJSONWidget
@@ -14,7 +14,7 @@ class CustomerAdmin(admin.ModelAdmin):
     list_display = ('name', 'exchange', 'quote',)
     readonly_fields = ('pk', 'name', 'exchange', 'quote',)
     ordering = ('pk',)
-    actions = ['fetch_orders', 'fetch_trades', 'asset_inventory', 'contract_inventory']
+    actions = ['fetch_orders', 'fetch_trades', 'asset_inventory', 'contract_inventory', 'backfill_rollups']
 
     def fetch_orders(self, request, queryset):
         for obj in queryset:
@@ -34,6 +34,12 @@ class CustomerAdmin(admin.ModelAdmin):
 
     asset_inventory.short_description = 'Update inventory of assets'
 
+    def backfill_rollups(self, request, queryset):
+        for obj in queryset:
+            backfill_rollups.delay(obj.pk)
+
+    backfill_rollups.short_description = 'Backfill balance rollups'
+
     def contract_inventory(self, request, queryset):
         for obj in queryset:
             update_contract_inventory.delay(obj.pk)
@@ -75,4 +81,25 @@ class CustomerAdmin(admin.ModelAdmin):
 
     formfield_overrides = {
         JSONField: {'widget': PrettyJSONWidget(attrs={'initial': 'parsed'})}
-    }
\ No newline at end of file
+    }
+
+@admin.register(SyncCursor)
+class CustomerAdmin(admin.ModelAdmin):
+    list_display = ('account', 'stream', 'wallet', 'symbol', 'since', 'dt_modified',)
+    readonly_fields = ('account', 'stream', 'wallet', 'symbol', 'since', 'dt_modified',)
+    ordering = ('account', 'stream', 'wallet', 'symbol',)
+    list_filter = (
+        ('account', admin.RelatedOnlyFieldListFilter),
+        'stream', 'wallet',
+    )
+
+
+@admin.register(BalanceRollup)
+class CustomerAdmin(admin.ModelAdmin):
+    list_display = ('bucket', 'account', 'resolution', 'assets_total_value', 'dt',)
+    readonly_fields = ('bucket', 'account', 'resolution', 'assets_total_value', 'weights', 'dt',)
+    ordering = ('-bucket',)
+    list_filter = (
+        ('account', admin.RelatedOnlyFieldListFilter),
+        'resolution',
+    )
@@ -0,0 +1,18 @@
+import django_filters
+from account.models import Trade
+
+
+class CharInFilter(django_filters.BaseInFilter, django_filters.CharFilter):
+    pass
+
+
+class TradeFilter(django_filters.FilterSet):
+    symbol = CharInFilter(field_name='symbol')  # comma separated symbols
+    side = django_filters.ChoiceFilter(choices=(('buy', 'buy'), ('sell', 'sell')))
+    market_type = django_filters.CharFilter(field_name='order__market__type')
+    start = django_filters.IsoDateTimeFilter(field_name='datetime', lookup_expr='gte')
+    end = django_filters.IsoDateTimeFilter(field_name='datetime', lookup_expr='lt')
+
+    class Meta:
+        model = Trade
+        fields = ['symbol', 'side', 'market_type', 'start', 'end']
@@ -0,0 +1,62 @@
+import base64
+from datetime import datetime
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Paginate a queryset from the latest to the oldest (datetime, id) with an opaque cursor of the last object
+    returned, so each page is an index range scan whatever its depth
+    """
+    page_size = 100
+    max_page_size = 1000
+
+    def get_page_size(self, request):
+        try:
+            return max(1, min(int(request.query_params.get('page_size', self.page_size)), self.max_page_size))
+        except ValueError:
+            return self.page_size
+
+    @staticmethod
+    def encode_cursor(obj):
+        return base64.urlsafe_b64encode('{0}|{1}'.format(obj.datetime.isoformat(), obj.pk).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            dt, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+            return datetime.fromisoformat(dt), pk
+        except (ValueError, UnicodeDecodeError):
+            raise NotFound('Invalid cursor')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        size = self.get_page_size(request)
+
+        qs = queryset.order_by('-datetime', '-id')
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            dt, pk = self.decode_cursor(cursor)
+            qs = qs.filter(Q(datetime__lt=dt) | Q(datetime=dt, id__lt=pk))
+
+        # Select one more object to know if there is a next page
+        page = list(qs[:size + 1])
+        self.cursor = self.encode_cursor(page[size - 1]) if len(page) > size else None
+        return page[:size]
+
+    def get_next_link(self):
+        if self.cursor:
+            return replace_query_param(self.request.build_absolute_uri(), 'cursor', self.cursor)
+
+    def get_paginated_response(self, data):
+        return Response(dict(next=self.get_next_link(), cursor=self.cursor, results=data))
+
+    def get_paginated_response_schema(self, schema):
+        return dict(type='object',
+                    properties=dict(next=dict(type='string', nullable=True),
+                                    cursor=dict(type='string', nullable=True),
+                                    results=schema))
@@ -2,7 +2,7 @@ from pprint import pprint
 from django.core.exceptions import ValidationError
 from django.shortcuts import get_object_or_404
 from rest_framework import serializers
-from account.models import Account, Balance
+from account.models import Account, Balance, Trade
 from market.models import Exchange, Currency
 import structlog
 log = structlog.get_logger(__name__)
@@ -44,6 +44,31 @@ class BalanceSerializer(serializers.ModelSerializer):
                 log.error('Validation error', error=item)
 
 
+class BalanceBulkSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    dt = serializers.DateTimeField()
+    assets_total_value = serializers.FloatField(default=0)
+    assets = serializers.JSONField()
+    open_position = serializers.JSONField(required=False, default=dict)
+
+    def validate_assets(self, value):
+        if not isinstance(value, dict):
+            raise serializers.ValidationError('Assets must be a dictionary')
+        return value
+
+
+class TradeSerializer(serializers.ModelSerializer):
+    orderid = serializers.CharField(source='order.orderid', read_only=True, allow_null=True)
+    base = serializers.CharField(source='order.market.base.code', read_only=True, allow_null=True)
+    quote = serializers.CharField(source='order.market.quote.code', read_only=True, allow_null=True)
+    market_type = serializers.CharField(source='order.market.type', read_only=True, allow_null=True)
+
+    class Meta:
+        model = Trade
+        fields = ('id', 'tradeid', 'orderid', 'symbol', 'base', 'quote', 'market_type', 'side', 'type',
+                  'taker_or_maker', 'datetime', 'timestamp', 'price', 'amount', 'cost', 'fee',)
+
+
 class AccountSerializer(serializers.ModelSerializer):
 
     class Meta:
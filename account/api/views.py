@@ -1,7 +1,22 @@
-from rest_framework import viewsets
-from account.api.serializers import AccountSerializer, BalanceSerializer
+from rest_framework import viewsets, generics
+from rest_framework.views import APIView
+from rest_framework.response import Response
+from rest_framework import status
+from django.http import StreamingHttpResponse, FileResponse
+from django.utils.dateparse import parse_datetime
+import tempfile
+from account.api.serializers import AccountSerializer, BalanceSerializer, BalanceBulkSerializer, TradeSerializer
+from account.api.filters import TradeFilter
+from account.api.pagination import KeysetPagination
+from account.models import Account, Trade
+from account.methods import upsert_balances
+from account.exports import exports, formats, select_rows, stream_csv, write_columnar
 from rest_framework.decorators import permission_classes
 from rest_framework.permissions import IsAdminUser
+from account.tasks import get_sync_metrics, schedule_update_inventory
+import structlog
+
+log = structlog.get_logger(__name__)
 
 
 # Create operation
@@ -15,3 +30,81 @@ class AccountViewSet(viewsets.ModelViewSet):
 class BalanceViewSet(viewsets.ModelViewSet):
     serializer_class = BalanceSerializer
     http_method_names = ['post']
+
+
+@permission_classes([IsAdminUser])
+class BalanceBulkViewSet(APIView):
+
+    def post(self, request):
+
+        serializer = BalanceBulkSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        snapshots = serializer.validated_data
+
+        pks = {dic['id'] for dic in snapshots}
+        unknown = pks - set(Account.objects.filter(pk__in=pks).values_list('pk', flat=True))
+        if unknown:
+            return Response(dict(unknown_accounts=sorted(unknown)), status=status.HTTP_400_BAD_REQUEST)
+
+        created, updated = upsert_balances(snapshots)
+        log.info('Balances bulk upsert', created=created, updated=updated, accounts=len(pks))
+
+        # One inventory update per account, with the assets of its latest snapshot
+        latest = dict()
+        for dic in sorted(snapshots, key=lambda dic: dic['dt']):
+            latest[dic['id']] = dic['assets']
+        for pk, assets in latest.items():
+            schedule_update_inventory(pk, assets)
+
+        return Response(dict(created=created, updated=updated), status=status.HTTP_201_CREATED)
+
+
+@permission_classes([IsAdminUser])
+class TradeViewSet(generics.ListAPIView):
+    serializer_class = TradeSerializer
+    pagination_class = KeysetPagination
+    filterset_class = TradeFilter
+
+    def get_queryset(self):
+        return Trade.objects.filter(account_id=self.kwargs['account_id']).select_related('order__market__base',
+                                                                                         'order__market__quote')
+
+
+@permission_classes([IsAdminUser])
+class ExportViewSet(APIView):
+
+    def get(self, request, account_id, name):
+        """
+        Stream trades, orders or inventory of an account as CSV, or as a Parquet or Feather file
+        """
+        fmt = request.GET.get('output', 'csv')
+        if name not in exports or fmt not in formats:
+            return Response(dict(exports=list(exports), outputs=formats), status=status.HTTP_400_BAD_REQUEST)
+
+        account = Account.objects.get(id=account_id)
+        start, end = [parse_datetime(request.GET[k]) if k in request.GET else None for k in ['start', 'end']]
+        columns, qs = select_rows(account, name, start, end)
+        filename = '{0}_{1}.{2}'.format(account.name, name, fmt)
+
+        if fmt == 'csv':
+            response = StreamingHttpResponse(stream_csv(columns, qs), content_type='text/csv')
+            response['Content-Disposition'] = 'attachment; filename="{0}"'.format(filename)
+            return response
+
+        # Columnar files are written in batches to a temporary file and streamed from disk
+        file = tempfile.TemporaryFile()
+        try:
+            write_columnar(exports[name][0], columns, qs, file, fmt)
+        except ImportError as e:
+            file.close()
+            return Response(dict(error=str(e)), status=status.HTTP_501_NOT_IMPLEMENTED)
+
+        file.seek(0)
+        return FileResponse(file, as_attachment=True, filename=filename)
+
+
+@permission_classes([IsAdminUser])
+class SyncMetricsViewSet(APIView):
+
+    def get(self, request, account_id):
+        return Response(get_sync_metrics(account_id))
@@ -1,11 +1,11 @@
-from django.db.models.functions import Cast
-from django.db.models import DateTimeField
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.decorators import permission_classes
 from rest_framework.permissions import IsAdminUser
 from accountant.methods import get_start_datetime, datetime_directive_ISO_8601
-from account.models import Balance, Account, Trade
+from accountant.cache import cached_response
+from account.models import Balance, Account
+from account.methods import select_recent_trades
 import structlog
 
 log = structlog.get_logger(__name__)
@@ -14,6 +14,7 @@ log = structlog.get_logger(__name__)
 @permission_classes([IsAdminUser])
 class OpenPositionViewSet(APIView):
 
+    @cached_response()
     def get(self, request, account_id):
 
         account = Account.objects.get(id=account_id)
@@ -25,6 +26,7 @@ class OpenPositionViewSet(APIView):
 @permission_classes([IsAdminUser])
 class NotionalValueViewSet(APIView):
 
+    @cached_response()
     def get(self, request, account_id):
 
         account = Account.objects.get(id=account_id)
@@ -36,6 +38,7 @@ class NotionalValueViewSet(APIView):
 @permission_classes([IsAdminUser])
 class ProfitAndLossViewSet(APIView):
 
+    @cached_response()
     def get(self, request, account_id):
         period = request.GET.get('period')
         growth = Account.objects.get(id=account_id).growth(period)
@@ -45,6 +48,7 @@ class ProfitAndLossViewSet(APIView):
 @permission_classes([IsAdminUser])
 class MarginLevelViewSet(APIView):
 
+    @cached_response('tickers')
     def get(self, request, account_id):
         exposition = Account.objects.get(id=account_id).current_exposition()
         return Response(exposition)
@@ -53,6 +57,7 @@ class MarginLevelViewSet(APIView):
 @permission_classes([IsAdminUser])
 class RiskLevelViewSet(APIView):
 
+    @cached_response()
     def get(self, request, account_id):
 
         period = request.GET.get('period')
@@ -63,15 +68,4 @@ class RiskLevelViewSet(APIView):
         account = Account.objects.get(id=account_id)
         start_datetime = get_start_datetime(account, period)
 
-        fields = ['account', 'amount', 'cost', 'datetime', 'fee',
-                  'order__orderid',
-                  'order__market__base__code',
-                  'order__market__quote__code',
-                  'order__market__type',
-                  'order__market__exchange',
-                  'price', 'side', 'symbol', 'taker_or_maker', 'timestamp', 'tradeid']
-
-        qs = Trade.objects.filter(account=account, datetime__gte=start_datetime).annotate(
-            date_only=Cast('datetime', DateTimeField())).order_by('-datetime').values(*fields)[:int(last_n)]
-
-        return Response(qs)
+        return Response(select_recent_trades(account, start_datetime, last_n))
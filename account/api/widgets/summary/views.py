@@ -1,128 +1,188 @@
-from django.db.models.functions import Cast
-from django.db.models import DateTimeField
+from django.db.models import OuterRef, Subquery
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.decorators import permission_classes
 from rest_framework.permissions import IsAdminUser
 from accountant.methods import get_start_datetime, datetime_directive_ISO_8601
-from account.models import Balance, Account, Trade
+from accountant.cache import cached_response
+from account.models import Balance, Account
 from market.models import Price
+from market.methods import get_market
+from account.methods import select_rollups, select_recent_trades
+from account.tasks import schedule_backfill_rollups
 import structlog
 
 log = structlog.get_logger(__name__)
 
 
+# Widgets computation, shared by widget views and the dashboard. Each function receives the account, its latest
+# balance and query parameters
+
+def assets(account, balance, params):
+    if balance is None:
+        return []
+    return [dict(dt=balance.dt, assets=balance.assets)]
+
+
+def assets_value(account, balance, params):
+    dic = balance.get_live_assets_value()
+    return dict(
+        total_value=dic['assets_total_value'],
+        last_update=dic['last_update'],
+    )
+
+
+def assets_growth(account, balance, params):
+    return account.growth(params.get('period'))
+
+
+def assets_exposition(account, balance, params):
+    return account.current_exposition(balance)
+
+
+def historical_value(account, balance, params):
+    start_datetime = get_start_datetime(account, params.get('period'))
+    schedule_backfill_rollups(account)
+
+    result = get_market(account.exchange, base='BTC', quote=account.quote.code, tp='spot')
+    if not result:
+        return dict()
+    market, flip = result
+
+    # Latest price of the market at the datetime of the bucket's balance
+    price = Price.objects.filter(market=market, dt__lte=OuterRef('dt')).order_by('-dt').values('last')[:1]
+
+    qs = select_rollups(account, start_datetime, params.get('resolution')).annotate(
+        bitcoin_price=Subquery(price)
+    ).values('point', 'assets_total_value', 'bitcoin_price')
+
+    data = {}
+    for dic in reversed(list(qs)):
+        if dic['bitcoin_price'] is not None:
+            str_date = dic['point'].strftime(datetime_directive_ISO_8601)
+            data[str_date] = dict(bitcoin_price=dic['bitcoin_price'],
+                                  assets_total_value=dic['assets_total_value'])
+
+    return data
+
+
+def historical_weight(account, balance, params):
+    start_datetime = get_start_datetime(account, params.get('period'))
+    schedule_backfill_rollups(account)
+    qs = select_rollups(account, start_datetime, params.get('resolution')).values('point', 'weights')
+
+    data = {}
+    for dic in reversed(list(qs)):
+        data[dic['point'].strftime(datetime_directive_ISO_8601)] = dic['weights']
+
+    return data
+
+
+def historical_trades(account, balance, params):
+    last_n = params.get('last_n')
+    if not last_n:
+        last_n = 5
+
+    start_datetime = get_start_datetime(account, params.get('period'))
+    return select_recent_trades(account, start_datetime, last_n)
+
+
+widgets = dict(assets=assets,
+               assets_value=assets_value,
+               assets_growth=assets_growth,
+               assets_exposition=assets_exposition,
+               historical_value=historical_value,
+               historical_weight=historical_weight,
+               historical_trades=historical_trades)
+
+
+def get_account(account_id):
+    return Account.objects.select_related('exchange', 'quote').get(id=account_id)
+
+
+def get_latest_balance(account):
+    return Balance.objects.filter(account=account).order_by('-dt').first()
+
+
 @permission_classes([IsAdminUser])
 class AssetsViewSet(APIView):
 
+    @cached_response()
     def get(self, request, account_id):
-
-        account = Account.objects.get(id=account_id)
-        qs = Balance.objects.filter(account=account).values("dt", "assets").order_by('-dt')[:1]
-
-        return Response(qs)
+        account = get_account(account_id)
+        return Response(assets(account, get_latest_balance(account), request.GET))
 
 
 @permission_classes([IsAdminUser])
 class AssetsValueViewSet(APIView):
 
+    @cached_response('tickers')
     def get(self, request, account_id):
-        dic = Balance.objects.filter(account__id=account_id).latest('dt').get_assets_value()
-        return Response(dict(
-            total_value=dic['assets_total_value'],
-            last_update=dic['last_update'],
-        )
-        )
+        account = get_account(account_id)
+        return Response(assets_value(account, Balance.objects.filter(account=account).latest('dt'), request.GET))
 
 
 @permission_classes([IsAdminUser])
 class AssetsGrowthViewSet(APIView):
 
+    @cached_response()
     def get(self, request, account_id):
-        period = request.GET.get('period')
-        growth = Account.objects.get(id=account_id).growth(period)
-        return Response(growth)
+        return Response(assets_growth(get_account(account_id), None, request.GET))
 
 
 @permission_classes([IsAdminUser])
 class AssetsExpositionViewSet(APIView):
 
+    @cached_response('tickers')
     def get(self, request, account_id):
-        exposition = Account.objects.get(id=account_id).current_exposition()
-        return Response(exposition)
+        return Response(assets_exposition(get_account(account_id), None, request.GET))
 
 
 @permission_classes([IsAdminUser])
 class HistoricalAssetsValueViewSet(APIView):
 
+    @cached_response('prices')
     def get(self, request, account_id):
-        period = request.GET.get('period')
-        account = Account.objects.get(id=account_id)
-        start_datetime = get_start_datetime(account, period)
-
-        price = Price.objects.filter(dt__gte=start_datetime, market__type='spot').annotate(
-            date_only=Cast('dt', DateTimeField())).values("date_only", "last").order_by('-dt')
-
-        qs = Balance.objects.filter(account=account, dt__gte=start_datetime).annotate(
-            date_only=Cast('dt', DateTimeField())).values("date_only", "assets_total_value").order_by('-dt')
-
-        data = {}
-        for (a, b) in zip(qs, price):
-            str_date = a['date_only'].strftime(datetime_directive_ISO_8601)
-            if a['date_only'] == b['date_only']:
-                data[str_date] = {}
-                data[str_date]['bitcoin_price'] = b['last']
-                data[str_date]['assets_total_value'] = a['assets_total_value']
-
-        return Response(data)
+        return Response(historical_value(get_account(account_id), None, request.GET))
 
 
 @permission_classes([IsAdminUser])
 class HistoricalAssetsWeightViewSet(APIView):
 
+    @cached_response()
     def get(self, request, account_id):
-        period = request.GET.get('period')
-        account = Account.objects.get(id=account_id)
-        start_datetime = get_start_datetime(account, period)
-
-        qs = Balance.objects.filter(account=account, dt__gte=start_datetime).annotate(
-            date_only=Cast('dt', DateTimeField())).values("date_only", "assets").order_by('-dt')
-
-        data = {}
-        for a in qs:
-            str_date = a['date_only'].strftime(datetime_directive_ISO_8601)
-            data[str_date] = dict()
-            codes = [c for c in a['assets'].keys() if c != 'last_update']
-            for code in codes:
-                if 'weight' in a['assets'][code]:
-                    data[str_date][code] = dict()
-                    data[str_date][code] = a['assets'][code]['weight']
-
-        return Response(data)
+        return Response(historical_weight(get_account(account_id), None, request.GET))
 
 
 @permission_classes([IsAdminUser])
 class HistoricalTradesViewSet(APIView):
 
+    @cached_response()
     def get(self, request, account_id):
+        return Response(historical_trades(get_account(account_id), None, request.GET))
 
-        period = request.GET.get('period')
-        last_n = request.GET.get('last_n')
-        if not last_n:
-            last_n = 5
-
-        account = Account.objects.get(id=account_id)
-        start_datetime = get_start_datetime(account, period)
 
-        fields = ['account', 'amount', 'cost', 'datetime', 'fee',
-                  'order__orderid',
-                  'order__market__base__code',
-                  'order__market__quote__code',
-                  'order__market__type',
-                  'order__market__exchange',
-                  'price', 'side', 'symbol', 'taker_or_maker', 'timestamp', 'tradeid']
+@permission_classes([IsAdminUser])
+class DashboardViewSet(APIView):
 
-        qs = Trade.objects.filter(account=account, datetime__gte=start_datetime).annotate(
-            date_only=Cast('datetime', DateTimeField())).order_by('-datetime').values(*fields)[:int(last_n)]
+    @cached_response('tickers', 'prices')
+    def get(self, request, account_id):
+        """
+        Return the widgets selected with a comma separated widgets parameter, or all widgets, in one response
+        """
+        names = request.GET.get('widgets')
+        names = [name for name in names.split(',') if name in widgets] if names else list(widgets)
+
+        # Objects shared by widgets
+        account = get_account(account_id)
+        balance = get_latest_balance(account)
+
+        data = dict()
+        for name in names:
+            try:
+                data[name] = widgets[name](account, balance, request.GET)
+            except Exception as e:
+                log.exception('Widget failure', widget=name)
+                data[name] = dict(error=str(e))
 
-        return Response(qs)
+        return Response(data)
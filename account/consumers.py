@@ -0,0 +1,123 @@
+import asyncio
+import time
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
+from account.models import Account, Balance
+import structlog
+
+log = structlog.get_logger(__name__)
+
+
+_missing = object()
+
+
+def get_delta(previous, current):
+    """
+    Return keys of current whose value differs from previous, recursively, removed keys are None
+    """
+    delta = dict()
+    for key in set(previous) | set(current):
+        if key not in current:
+            delta[key] = None
+        elif isinstance(current[key], dict) and isinstance(previous.get(key), dict):
+            nested = get_delta(previous[key], current[key])
+            if nested:
+                delta[key] = nested
+        elif previous.get(key, _missing) != current[key]:
+            delta[key] = current[key]
+    return delta
+
+
+def get_snapshot(account_id):
+    """
+    Return valuation, exposition and open position of an account at the latest prices
+    """
+    account = Account.objects.select_related('exchange', 'quote').get(id=account_id)
+    balance = Balance.objects.filter(account=account).order_by('-dt').first()
+    if balance is None:
+        return dict()
+
+    valuation = dict(balance.get_live_assets_value())
+    valuation.pop('last_update', None)
+
+    try:
+        exposition = account.current_exposition(balance)
+    except Exception:
+        exposition = None
+
+    position = balance.get_position_value()
+    position.pop('last_update', None)
+
+    return dict(dt=balance.dt.isoformat(),
+                assets_value=valuation,
+                exposition=exposition,
+                open_position=position)
+
+
+class AccountConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Push changes of an account valuation, exposition and open position after balance writes and ticker flushes.
+    The full snapshot is sent on connection, then only deltas at most every LIVE_UPDATES_THROTTLE seconds
+    """
+
+    async def connect(self):
+        user = self.scope.get('user')
+        if not user or not user.is_staff:
+            await self.close()
+            return
+
+        self.account_id = int(self.scope['url_route']['kwargs']['account_id'])
+        self.groups_joined = ['account_{0}'.format(self.account_id), 'tickers']
+        self.snapshot = dict()
+        self.pushed = 0
+        self.pending = None
+
+        for group in self.groups_joined:
+            await self.channel_layer.group_add(group, self.channel_name)
+
+        await self.accept()
+        await self.push()
+
+    async def disconnect(self, code):
+        if self.pending:
+            self.pending.cancel()
+        for group in getattr(self, 'groups_joined', []):
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def balance_updated(self, event):
+        await self.schedule()
+
+    async def tickers_updated(self, event):
+        await self.schedule()
+
+    async def schedule(self):
+        """
+        Push now or once the throttle delay is elapsed, events received meanwhile are coalesced
+        """
+        if self.pending:
+            return
+
+        delay = self.pushed + settings.LIVE_UPDATES_THROTTLE - time.monotonic()
+        if delay <= 0:
+            await self.push()
+        else:
+            self.pending = asyncio.ensure_future(self.push_later(delay))
+
+    async def push_later(self, delay):
+        await asyncio.sleep(delay)
+        self.pending = None
+        await self.push()
+
+    async def push(self):
+        self.pushed = time.monotonic()
+        try:
+            snapshot = await database_sync_to_async(get_snapshot)(self.account_id)
+        except Exception:
+            log.exception('Live update failure', account=self.account_id)
+            return
+
+        delta = get_delta(self.snapshot, snapshot)
+        if delta:
+            self.snapshot = snapshot
+            await self.send_json(delta)
@@ -0,0 +1,121 @@
+import csv
+import json
+from django.conf import settings
+from django.db import models
+from account.models import Order, Trade
+from pnl.models import Inventory
+import structlog
+
+log = structlog.get_logger(__name__)
+
+# Model and columns of each export, related columns are lookups
+exports = dict(
+    trades=(Trade, ['id', 'tradeid', 'order__orderid', 'symbol', 'side', 'type', 'taker_or_maker', 'datetime',
+                    'timestamp', 'price', 'amount', 'cost', 'fee', 'fees']),
+    orders=(Order, ['id', 'orderid', 'clientid', 'market__symbol', 'market__type', 'status', 'type', 'side',
+                    'amount', 'remaining', 'filled', 'cost', 'average', 'price', 'fee', 'datetime', 'timestamp',
+                    'last_trade_timestamp']),
+    inventory=(Inventory, ['id', 'trade__tradeid', 'currency__code', 'instrument', 'stock', 'total_cost',
+                           'average_cost', 'realized_pnl', 'unrealized_pnl', 'datetime']),
+)
+
+formats = ['csv', 'parquet', 'feather']
+
+
+def select_rows(account, name, start=None, end=None):
+    """
+    Return columns and a queryset of tuples of an export, ordered by datetime
+    """
+    model, columns = exports[name]
+    qs = model.objects.filter(account=account)
+    if start:
+        qs = qs.filter(datetime__gte=start)
+    if end:
+        qs = qs.filter(datetime__lt=end)
+    return columns, qs.order_by('datetime', 'id').values_list(*columns)
+
+
+def iter_rows(qs):
+    """
+    Iterate rows with a server-side cursor, JSON values are serialized
+    """
+    for row in qs.iterator(chunk_size=settings.EXPORT_CHUNK_SIZE):
+        yield [json.dumps(v) if isinstance(v, (dict, list)) else v for v in row]
+
+
+class Echo:
+    def write(self, value):
+        return value
+
+
+def stream_csv(columns, qs):
+    """
+    Yield lines of a CSV file, rows are never materialized together
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+    for row in iter_rows(qs):
+        yield writer.writerow(row)
+
+
+def get_field(model, lookup):
+    for name in lookup.split('__')[:-1]:
+        model = model._meta.get_field(name).related_model
+    return model._meta.get_field(lookup.split('__')[-1])
+
+
+def get_schema(model, columns):
+    """
+    Return the Arrow schema of columns, so every batch of a file has the same types
+    """
+    import pyarrow as pa
+
+    types = []
+    for column in columns:
+        field = get_field(model, column)
+        if isinstance(field, models.FloatField):
+            types.append(pa.float64())
+        elif isinstance(field, (models.IntegerField, models.BigIntegerField)):
+            types.append(pa.int64())
+        elif isinstance(field, models.DateTimeField):
+            types.append(pa.timestamp('us', tz='UTC'))
+        elif isinstance(field, models.BooleanField):
+            types.append(pa.bool_())
+        else:
+            types.append(pa.string())
+    return pa.schema([pa.field(column, tp) for column, tp in zip(columns, types)])
+
+
+def write_columnar(model, columns, qs, file, fmt):
+    """
+    Write rows to a Parquet or Feather file in batches of EXPORT_CHUNK_SIZE rows, return the number of rows
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('pyarrow is required to export {0} files'.format(fmt))
+
+    schema = get_schema(model, columns)
+    writer = pq.ParquetWriter(file, schema) if fmt == 'parquet' else pa.ipc.new_file(file, schema)
+
+    def write(batch):
+        arrays = [pa.array([str(v) if v is not None and tp == pa.string() else v for v in values], type=tp)
+                  for values, tp in zip(zip(*batch), schema.types)]
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+    n, batch = 0, []
+    try:
+        for row in iter_rows(qs):
+            batch.append(row)
+            if len(batch) == settings.EXPORT_CHUNK_SIZE:
+                write(batch)
+                n, batch = n + len(batch), []
+        if batch:
+            write(batch)
+            n += len(batch)
+    finally:
+        writer.close()
+
+    log.info('Export written', format=fmt, rows=n)
+    return n
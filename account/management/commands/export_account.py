@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+from account.models import Account
+from account.exports import exports, formats, select_rows, stream_csv, write_columnar
+
+
+class Command(BaseCommand):
+    help = 'Export trades, orders or inventory of an account to a CSV, Parquet or Feather file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('account', type=int)
+        parser.add_argument('name', choices=list(exports))
+        parser.add_argument('path')
+        parser.add_argument('--output', default='csv', choices=formats)
+        parser.add_argument('--start', type=parse_datetime)
+        parser.add_argument('--end', type=parse_datetime)
+
+    def handle(self, *args, **options):
+
+        try:
+            account = Account.objects.get(pk=options['account'])
+        except Account.DoesNotExist:
+            raise CommandError('Account {0} does not exist'.format(options['account']))
+
+        name, fmt = options['name'], options['output']
+        columns, qs = select_rows(account, name, options['start'], options['end'])
+
+        if fmt == 'csv':
+            n = -1
+            with open(options['path'], 'w', newline='') as f:
+                for line in stream_csv(columns, qs):
+                    f.write(line)
+                    n += 1
+        else:
+            try:
+                with open(options['path'], 'wb') as f:
+                    n = write_columnar(exports[name][0], columns, qs, f, fmt)
+            except ImportError as e:
+                raise CommandError(str(e))
+
+        self.stdout.write('{0} {1} exported to {2}'.format(n, name, options['path']))
@@ -0,0 +1,462 @@
+import pytz
+from datetime import datetime
+from django.conf import settings
+from django.db.models import F, Q
+from django.db.models.functions import Trunc
+from django.db import transaction
+from accountant.methods import datetime_directive_ccxt, send_event
+from accountant.cache import bump_account_version
+from account.models import Account, Order, Trade, Balance, BalanceRollup, SyncCursor
+from market.models import Market
+import structlog
+
+log = structlog.get_logger(__name__)
+
+
+def to_aware_datetime(string):
+    if string:
+        return datetime.strptime(string, datetime_directive_ccxt).replace(tzinfo=pytz.UTC)
+
+
+def create_trades(account, response):
+    """
+    Insert trades of a fetchMyTrades() response not in database yet and link trades stored before their
+    order, return the number of trades created
+    """
+    if not response:
+        return 0
+
+    # Resolve orders with a single query
+    orderids = {dic['order'] for dic in response if dic['order']}
+    orders = dict(Order.objects.filter(account=account, orderid__in=orderids).values_list('orderid', 'id'))
+
+    # Select trades already in database
+    existing = {(obj.tradeid, obj.symbol): obj for obj in
+                Trade.objects.filter(account=account,
+                                     tradeid__in={dic['id'] for dic in response}
+                                     ).only('id', 'tradeid', 'symbol', 'order_id')}
+
+    trades, linked = [], []
+    for dic in response:
+
+        key = (dic['id'], dic['symbol'])
+        if key in existing:
+            obj = existing[key]
+            if obj is not None and obj.order_id is None and orders.get(dic['order']):
+                obj.order_id = orders[dic['order']]
+                linked.append(obj)
+            continue
+        existing[key] = None
+
+        trades.append(Trade(account=account,
+                            tradeid=dic['id'],
+                            amount=dic['amount'],
+                            cost=dic['cost'],
+                            datetime=to_aware_datetime(dic['datetime']),
+                            fee=dic['fee'],
+                            fees=dic['fees'],
+                            info=dic['info'],
+                            order_id=orders.get(dic['order']),
+                            price=dic['price'],
+                            side=dic['side'],
+                            symbol=dic['symbol'],
+                            taker_or_maker=dic['takerOrMaker'],
+                            timestamp=dic['timestamp'],
+                            type=dic['type']
+                            ))
+
+    with transaction.atomic():
+        Trade.objects.bulk_create(trades, ignore_conflicts=True)
+        if linked:
+            Trade.objects.bulk_update(linked, ['order'])
+
+    if trades or linked:
+        bump_account_version(account.pk)
+    return len(trades)
+
+
+def create_update_orders(account, response, markets):
+    """
+    Insert new orders and update changed orders of a fetchOrders() response, return the numbers of orders
+    created and updated. markets maps symbols to Market primary keys.
+    """
+    values = dict()
+    for dic in response:
+
+        # Skip orders of unknown markets
+        if dic['symbol'] not in markets:
+            continue
+
+        values[dic['id']] = dict(
+            amount=dic['amount'],
+            average=dic['average'],
+            clientid=dic['clientOrderId'],
+            cost=dic['cost'],
+            datetime=to_aware_datetime(dic['datetime']),
+            fee=dic['fee'],
+            fees=dic['fees'],
+            filled=dic['filled'],
+            info=dic['info'],
+            market_id=markets[dic['symbol']],
+            price=dic['price'],
+            remaining=dic['remaining'],
+            side=dic['side'],
+            status=dic['status'],
+            trades=dic['trades'],
+            type=dic['type'],
+        )
+
+    if not values:
+        return 0, 0
+
+    existing = {obj.orderid: obj for obj in Order.objects.filter(account=account, orderid__in=values.keys())}
+    created, updated, fields = [], [], set()
+
+    for orderid, dic in values.items():
+        if orderid in existing:
+
+            # Write changed fields only
+            obj = existing[orderid]
+            changed = [k for k, v in dic.items() if getattr(obj, k) != v]
+            if changed:
+                for k in changed:
+                    setattr(obj, k, dic[k])
+                    fields.add('market' if k == 'market_id' else k)
+                updated.append(obj)
+
+        else:
+            created.append(Order(account=account, orderid=orderid, **dic))
+
+    with transaction.atomic():
+        Order.objects.bulk_create(created, ignore_conflicts=True)
+        if updated:
+            Order.objects.bulk_update(updated, sorted(fields))
+
+    if created or updated:
+        bump_account_version(account.pk)
+    return len(created), len(updated)
+
+
+def upsert_balances(snapshots):
+    """
+    Insert or update balances of validated snapshots on (dt, account), return the number of balances created
+    and updated. Snapshots with the same (dt, account) are deduplicated, the last one wins
+    """
+    snapshots = {(dic['id'], dic['dt']): dic for dic in snapshots}
+    if not snapshots:
+        return 0, 0
+
+    accounts = Account.objects.select_related('exchange', 'quote').in_bulk({pk for pk, dt in snapshots})
+    existing = {(obj.account_id, obj.dt): obj for obj in
+                Balance.objects.filter(account_id__in={pk for pk, dt in snapshots},
+                                       dt__in={dt for pk, dt in snapshots})}
+
+    create, update = [], []
+    for (pk, dt), dic in snapshots.items():
+        obj = existing.get((pk, dt))
+        if obj is None:
+            obj = Balance(account_id=pk, dt=dt)
+            create.append(obj)
+        else:
+            update.append(obj)
+
+        obj.assets_total_value = dic['assets_total_value']
+        obj.assets = dic['assets']
+        obj.open_position = dic.get('open_position', dict())
+        obj.account = accounts[pk]
+        obj.try_value_assets()
+
+    with transaction.atomic():
+        Balance.objects.bulk_create(create)
+        Balance.objects.bulk_update(update, ['assets_total_value', 'assets', 'open_position', 'assets_value', 'prices',
+                                             'valued_at'])
+        update_rollups(create + update)
+
+    for pk in accounts:
+        bump_account_version(pk)
+        send_event('account_{0}'.format(pk), 'balance.updated')
+
+    return len(create), len(update)
+
+
+def truncate(dt, resolution):
+    if resolution == BalanceRollup.Resolution.HOUR:
+        return dt.replace(minute=0, second=0, microsecond=0)
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def get_weights(balance):
+    """
+    Return the weight of each asset of a balance, from its valuation or from the weights of its assets
+    """
+    source = balance.assets_value or balance.assets
+    return {code: dic['weight'] for code, dic in source.items() if isinstance(dic, dict) and 'weight' in dic}
+
+
+def update_rollups(balances):
+    """
+    Update hourly and daily rollups with balances, a bucket holds its latest balance. Return the number of
+    rollups created and updated
+    """
+    latest = dict()
+    for obj in balances:
+        for resolution in BalanceRollup.Resolution.values:
+            key = (obj.account_id, resolution, truncate(obj.dt, resolution))
+            if key not in latest or obj.dt > latest[key].dt:
+                latest[key] = obj
+
+    if not latest:
+        return 0, 0
+
+    def select(keys):
+        return {(obj.account_id, obj.resolution, obj.bucket): obj for obj in
+                BalanceRollup.objects.filter(account_id__in={key[0] for key in keys},
+                                             bucket__in={key[2] for key in keys})}
+
+    def apply(obj, balance):
+        obj.dt = balance.dt
+        obj.assets_total_value = balance.assets_total_value
+        obj.weights = get_weights(balance)
+
+    existing = select(latest)
+    create, update = [], []
+    for (pk, resolution, bucket), balance in latest.items():
+        obj = existing.get((pk, resolution, bucket))
+        if obj is None:
+            obj = BalanceRollup(account_id=pk, resolution=resolution, bucket=bucket)
+            create.append(obj)
+        elif obj.dt > balance.dt:
+            continue
+        else:
+            update.append(obj)
+        apply(obj, balance)
+
+    with transaction.atomic():
+        BalanceRollup.objects.bulk_create(create, ignore_conflicts=True)
+
+        # Buckets inserted by a concurrent writer since the lookup are skipped by the insert, the latest
+        # balance still wins
+        if create:
+            keys = {(obj.account_id, obj.resolution, obj.bucket) for obj in create}
+            for key, obj in select(keys).items():
+                if key in keys and obj.dt < latest[key].dt:
+                    apply(obj, latest[key])
+                    update.append(obj)
+
+        BalanceRollup.objects.bulk_update(update, ['dt', 'assets_total_value', 'weights'])
+
+    return len(create), len(update)
+
+
+def select_resolution(start_datetime):
+    """
+    Return the coarsest rollup resolution that charts a period with enough points
+    """
+    if (datetime.utcnow() - start_datetime.replace(tzinfo=None)).days <= settings.ROLLUP_HOURLY_MAX_DAYS:
+        return BalanceRollup.Resolution.HOUR
+    return BalanceRollup.Resolution.DAY
+
+
+def select_rollups(account, start_datetime, resolution=None):
+    """
+    Return rollups of an account since start_datetime with a point datetime, week and month points are the
+    latest daily rollup of the week or month
+    """
+    if resolution not in ['hour', 'day', 'week', 'month']:
+        resolution = select_resolution(start_datetime)
+
+    qs = BalanceRollup.objects.filter(account=account,
+                                      resolution='hour' if resolution == 'hour' else 'day',
+                                      bucket__gte=start_datetime)
+
+    if resolution in ['week', 'month']:
+        return qs.annotate(point=Trunc('bucket', resolution)).order_by('point', '-bucket').distinct('point')
+    return qs.annotate(point=F('bucket')).order_by('point')
+
+
+def select_recent_trades(account, start_datetime, last_n=5):
+    """
+    Return values of the latest trades of an account since start_datetime, with their order and market
+    """
+    fields = ['account', 'amount', 'cost', 'datetime', 'fee',
+              'order__orderid',
+              'order__market__base__code',
+              'order__market__quote__code',
+              'order__market__type',
+              'order__market__exchange',
+              'price', 'side', 'symbol', 'taker_or_maker', 'timestamp', 'tradeid']
+
+    qs = Trade.objects.filter(account=account, datetime__gte=start_datetime).order_by('-datetime', '-id')
+    return list(qs.values(*fields)[:int(last_n)])
+
+
+def to_timestamp(dt):
+    return int(dt.timestamp() * 1000)
+
+
+def get_cursor(account, stream, wallet=None, symbol=None, since=None):
+    """
+    Return the sync cursor of a stream, created at since if it doesn't exist
+    """
+    cursor, created = SyncCursor.objects.get_or_create(account=account,
+                                                       stream=stream,
+                                                       wallet=wallet or '',
+                                                       symbol=symbol or '',
+                                                       defaults=dict(since=since))
+    return cursor
+
+
+def get_trades_cursor(account, symbol, wallet=None):
+    """
+    Return the trades cursor of a symbol, created at the latest trade of the symbol in database. Trades of
+    that millisecond are fetched again and deduplicated by create_trades()
+    """
+    qs = Trade.objects.filter(account=account, symbol=symbol)
+    since = to_timestamp(qs.latest('datetime').datetime) if qs.exists() else to_timestamp(account.dt_created)
+    return get_cursor(account, SyncCursor.Stream.TRADES, wallet, symbol, since=since)
+
+
+def is_sweep_due(account):
+    """
+    Return True if trades of every market should be fetched
+    """
+    cursor = get_cursor(account, SyncCursor.Stream.SWEEP)
+    interval = settings.FETCH_TRADES_SWEEP_INTERVAL * 3600 * 1000
+    return not cursor.since or to_timestamp(datetime.now(pytz.UTC)) - cursor.since > interval
+
+
+def mark_sweep(account):
+    """
+    Record the completion of a sweep
+    """
+    cursor = get_cursor(account, SyncCursor.Stream.SWEEP)
+    cursor.since = to_timestamp(datetime.now(pytz.UTC))
+    cursor.save()
+
+
+def select_symbols(account, wallet=None, sweep=False):
+    """
+    Return symbols whose trades should be fetched : markets with orders or trades, markets of currencies
+    in the latest balance and symbols of settings, or every market during a sweep
+    """
+    qs = Market.objects.filter(exchange=account.exchange)
+    if wallet:
+        qs = qs.filter(wallet=wallet)
+
+    if not sweep:
+        condition = Q(symbol__in=settings.FETCH_TRADES_SYMBOLS)
+        condition |= Q(pk__in=Order.objects.filter(account=account).values('market_id'))
+        condition |= Q(symbol__in=Trade.objects.filter(account=account).values('symbol'))
+
+        balance = Balance.objects.filter(account=account).order_by('-dt').first()
+        if balance:
+            codes = [code for code, dic in balance.assets.items()
+                     if isinstance(dic, dict) and dic.get('quantity', {}).get('total')]
+            condition |= Q(base__code__in=codes)
+
+        qs = qs.filter(condition)
+
+    return list(qs.values_list('symbol', flat=True).distinct())
+
+
+def advance_page(page, seen, hold=None, pending=None):
+    """
+    Return the since of the next page, the oldest pending timestamp and the since to persist, or None
+    if the page holds no object unseen on the previous page and the cursor can't advance
+    """
+    if all(dic['id'] in seen for dic in page):
+        return None
+
+    # Objects sharing the latest millisecond may continue on the next page, so it starts at that
+    # millisecond and the objects already ingested are deduplicated by ingest()
+    latest = max(dic['timestamp'] for dic in page)
+
+    if pending:
+        timestamp = pending(page)
+        if timestamp and (not hold or timestamp < hold):
+            hold = timestamp
+
+    return latest, hold, min(hold, latest) if hold else latest
+
+
+def commit_page(ingest, page, cursor, since):
+    """
+    Ingest a page and advance the cursor in the same transaction, return the number of objects written
+    """
+    with transaction.atomic():
+        n = ingest(page)
+        if cursor.since != since:
+            cursor.since = since
+            cursor.save()
+    return n
+
+
+def fetch_pages(fetch, ingest, cursor, limit, pending=None):
+    """
+    Fetch pages from the cursor until no new data is returned, each page is ingested and the cursor advanced in
+    the same transaction so an interrupted fetch resumes after the last committed page.
+
+    fetch(since, limit) returns a page of dictionaries with a timestamp, ingest(page) returns the number of
+    objects written and pending(page) returns the timestamp of the oldest object that can still change.
+    """
+    since, hold, seen, n = cursor.since, None, set(), 0
+
+    while True:
+
+        page = [dic for dic in fetch(since, limit) if dic['timestamp']]
+        if not page:
+            break
+
+        advance = advance_page(page, seen, hold, pending)
+        if advance is None:
+            # A full page of objects sharing the since millisecond can't be paged through, skip it
+            if len(page) >= limit and all(dic['timestamp'] == since for dic in page):
+                log.warning('Cursor is not advancing', stream=cursor.stream, symbol=cursor.symbol)
+                since, seen = since + 1, set()
+                continue
+            break
+
+        since, hold, persisted = advance
+        seen = set(dic['id'] for dic in page)
+        written = commit_page(ingest, page, cursor, persisted)
+        n += written
+
+        # A short page that wrote nothing is the tail already in database, don't request it again
+        if not written and len(page) < limit:
+            break
+
+    return n
+
+
+async def fetch_pages_async(fetch, ingest, cursor, limit, writer, pending=None):
+    """
+    Coroutine of fetch_pages() with an awaitable fetch(), pages are committed by the database writer
+    and the next page is requested once the previous one is committed
+    """
+    since, hold, seen, n = cursor.since, None, set(), 0
+
+    while True:
+
+        page = [dic for dic in await fetch(since, limit) if dic['timestamp']]
+        if not page:
+            break
+
+        advance = advance_page(page, seen, hold, pending)
+        if advance is None:
+            # A full page of objects sharing the since millisecond can't be paged through, skip it
+            if len(page) >= limit and all(dic['timestamp'] == since for dic in page):
+                log.warning('Cursor is not advancing', stream=cursor.stream, symbol=cursor.symbol)
+                since, seen = since + 1, set()
+                continue
+            break
+
+        since, hold, persisted = advance
+        seen = set(dic['id'] for dic in page)
+        written = await writer.call(commit_page, ingest, page, cursor, persisted)
+        n += written
+
+        # A short page that wrote nothing is the tail already in database, don't request it again
+        if not written and len(page) < limit:
+            break
+
+    return n
@@ -5,7 +5,7 @@ from django.core.exceptions import ObjectDoesNotExist
 from accountant.models import TimestampedModel
 from accountant.methods import datetime_directive_ISO_8601, get_start_datetime, dt_aware_now
 from market.models import Market, Exchange, Currency
-from market.methods import get_market
+from market.methods import get_market, get_last_price, get_last_prices
 import structlog
 
 logger = structlog.get_logger(__name__)
@@ -62,13 +62,14 @@ class Account(TimestampedModel):
                 growth_rate=cumulated_realized_pnl / initial_asset_value
             )
 
-    def current_exposition(self):
+    def current_exposition(self, balance=None):
 
         code = 'BTC'
-        balance = Balance.objects.filter(account=self).latest('dt')
+        if balance is None:
+            balance = Balance.objects.filter(account=self).latest('dt')
 
         # Select asset value
-        asset = balance.get_assets_value()
+        asset = balance.get_live_assets_value()
         assets_value_total = asset['assets_total_value']
         exposition_value = asset[code]['value']['total']
 
@@ -104,6 +105,7 @@ class Order(TimestampedModel):
 
     class Meta:
         verbose_name_plural = "Orders"
+        unique_together = ('account', 'orderid',)
         permissions = [
             ("cancel_order", "Can cancel an open order"),
         ]
@@ -135,6 +137,7 @@ class Trade(TimestampedModel):
     class Meta:
         verbose_name_plural = "Trades"
         unique_together = ('datetime', 'tradeid', 'symbol', 'account',)
+        indexes = [models.Index(fields=['account', 'datetime', 'id'], name='trade_account_datetime_idx')]
 
     def save(self, *args, **kwargs):
         return super(Trade, self).save(*args, **kwargs)
@@ -143,6 +146,30 @@ class Trade(TimestampedModel):
         return self.tradeid
 
 
+class SyncCursor(TimestampedModel):
+
+    class Stream(models.TextChoices):
+        TRADES = 'trades', "TRADES"
+        ORDERS = 'orders', "ORDERS"
+        SWEEP = 'sweep', "SWEEP"
+
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='cursor')
+    wallet = models.CharField(max_length=20, blank=True, default='')
+    symbol = models.CharField(max_length=50, blank=True, default='')
+    stream = models.CharField(max_length=10, choices=Stream.choices)
+    since = models.BigIntegerField(null=True)  # timestamp (ms) of the next page
+
+    class Meta:
+        verbose_name_plural = "Sync cursors"
+        unique_together = ('account', 'wallet', 'symbol', 'stream',)
+
+    def save(self, *args, **kwargs):
+        return super(SyncCursor, self).save(*args, **kwargs)
+
+    def __str__(self):
+        return '_'.join([str(self.account), self.stream, self.wallet, self.symbol])
+
+
 class Balance(TimestampedModel):
     id = models.UUIDField(default=uuid.uuid4, primary_key=True, editable=False)
     account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='balance', null=True)
@@ -150,49 +177,112 @@ class Balance(TimestampedModel):
     assets = models.JSONField(default=dict)
     open_position = models.JSONField(default=dict, blank=True, null=True)
     dt = models.DateTimeField()
+    assets_value = models.JSONField(default=dict, blank=True)  # value and weight of assets at prices
+    prices = models.JSONField(default=dict, blank=True)  # market id and price used to value each asset
+    valued_at = models.DateTimeField(blank=True, null=True)
 
     class Meta:
         verbose_name_plural = "Balances"
         unique_together = ('dt', 'account',)
 
     def save(self, *args, **kwargs):
+        if self.assets and self.account_id:
+            self.try_value_assets()
         return super(Balance, self).save(*args, **kwargs)
 
     def __str__(self):
         return str(self.dt.strftime(datetime_directive_ISO_8601))
 
-    def get_assets_value(self):
+    def get_prices(self):
         """
-        Return assets value with the latest ticker price
+        Return market id and latest price of each asset, the price of the quote is 1
         """
-        log = logger.bind(account=self.account.name)
-        log.info('Get latest assets value')
-
-        dic = dict()
         quote = self.account.quote.code
+        markets = dict()
         for code in self.assets.keys():
+            if code != quote:
+                result = get_market(self.account.exchange, base=code, quote=quote, tp='spot')
+                if not result:
+                    logger.warning('Asset without market', code=code, account=self.account.name)
+                    markets[code] = None
+                else:
+                    markets[code] = result[0].pk
+
+        prices = get_last_prices([pk for pk in markets.values() if pk])
+        return {code: [markets[code], prices.get(markets[code])] if code != quote else [None, 1]
+                for code in self.assets.keys()}
+
+    def value_assets(self, prices=None):
+        """
+        Value assets at prices or at the latest prices and keep the valuation in the object, not saved
+        """
+        if prices is None:
+            prices = self.get_prices()
+
+        dic = dict()
+        for code, (pk, last) in prices.items():
 
             dic[code] = dict()
             dic[code]['value'] = dict()
             dic[code]['quantity'] = dict()
 
-            if code != quote:
-                market, flip = get_market(self.account.exchange, base=code, quote=quote, tp='spot')
-                last = market.ticker['last']
-
-            else:
-                last = 1
-
             for key in ['total', 'free', 'used']:
                 dic[code]['quantity'][key] = self.assets[code]['quantity'][key]
-                dic[code]['value'][key] = self.assets[code]['quantity'][key] * last
+                dic[code]['value'][key] = self.assets[code]['quantity'][key] * last if last else 0
+
+        # Calculate total assets value and weights
+        total = sum([dic[code]['value']['total'] for code in prices.keys()])
+        for code in prices.keys():
+            dic[code]['weight'] = dic[code]['value']['total'] / total if total else 0
 
-        # Calculate total assets value
-        dic['assets_total_value'] = sum([dic['total'] for dic in [k['value'] for k in [v for v in dic.values()]]])
+        dic['assets_total_value'] = total
         dic['last_update'] = datetime.utcnow().strftime(datetime_directive_ISO_8601)
 
+        self.assets_value = dic
+        self.prices = prices
+        self.valued_at = dt_aware_now()
         return dic
 
+    def try_value_assets(self):
+        """
+        Value assets, a failure is logged and leaves the balance unvalued so the snapshot is still written
+        """
+        try:
+            self.value_assets()
+        except Exception:
+            logger.exception('Assets valuation failure', account=self.account_id, dt=str(self.dt))
+            self.assets_value, self.prices, self.valued_at = dict(), dict(), None
+            return False
+        return True
+
+    def get_live_assets_value(self):
+        """
+        Return the assets valuation, recomputed and saved only if the price of an asset has moved
+        """
+        if not self.prices:
+            self.value_assets()
+
+        else:
+            latest = get_last_prices([pk for pk, last in self.prices.values() if pk])
+            prices = {code: [pk, latest.get(pk, last)] if pk else [pk, last] for code, (pk, last) in
+                      self.prices.items()}
+            if prices == self.prices:
+                return self.assets_value
+
+            self.value_assets(prices)
+
+        # Update the row without post_save signal
+        Balance.objects.filter(pk=self.pk).update(assets_value=self.assets_value,
+                                                  prices=self.prices,
+                                                  valued_at=self.valued_at)
+        return self.assets_value
+
+    def get_assets_value(self):
+        """
+        Return assets value with the latest ticker price
+        """
+        return self.get_live_assets_value()
+
     def get_position_value(self):
         """
         Return notional value of open positions with the latest ticker price
@@ -208,7 +298,7 @@ class Balance(TimestampedModel):
 
             # Get last price
             market, flip = get_market(self.account.exchange, symbol=symbol)
-            last = market.ticker['last']
+            last = get_last_price(market)
 
             position_value = contacts * last if side == 'buy' else -contacts * last
 
@@ -221,3 +311,27 @@ class Balance(TimestampedModel):
 
         else:
             return dict()
+
+
+class BalanceRollup(TimestampedModel):
+
+    class Resolution(models.TextChoices):
+        HOUR = 'hour', "HOUR"
+        DAY = 'day', "DAY"
+
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='rollup')
+    resolution = models.CharField(max_length=4, choices=Resolution.choices)
+    bucket = models.DateTimeField()
+    dt = models.DateTimeField()  # datetime of the latest balance of the bucket
+    assets_total_value = models.FloatField(default=0)
+    weights = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        verbose_name_plural = "Balance rollups"
+        unique_together = ('account', 'resolution', 'bucket',)
+
+    def save(self, *args, **kwargs):
+        return super(BalanceRollup, self).save(*args, **kwargs)
+
+    def __str__(self):
+        return '_'.join([str(self.account), self.resolution, self.bucket.strftime(datetime_directive_ISO_8601)])
@@ -0,0 +1,6 @@
+from django.urls import re_path
+from account.consumers import AccountConsumer
+
+websocket_urlpatterns = [
+    re_path(r'ws/account/(?P<account_id>\d+)/$', AccountConsumer.as_asgi()),
+]
@@ -1,7 +1,10 @@
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from account.models import Balance
-from account.tasks import update_inventory
+from account.tasks import schedule_update_inventory
+from account.methods import update_rollups
+from accountant.cache import bump_account_version
+from accountant.methods import send_event
 import structlog
 
 log = structlog.get_logger(__name__)
@@ -9,4 +12,8 @@ log = structlog.get_logger(__name__)
 
 @receiver(post_save, sender=Balance)
 def balance_saved(sender, instance, created, raw, using, **kwargs):
-    update_inventory(instance.account.pk)
+    update_rollups([instance])
+    bump_account_version(instance.account_id)
+    send_event('account_{0}'.format(instance.account_id), 'balance.updated')
+    if schedule_update_inventory(instance.account.pk, instance.assets):
+        log.info('Inventory update scheduled', account=instance.account.name)
@@ -1,15 +1,20 @@
 from __future__ import absolute_import, unicode_literals
-import pytz
 from pprint import pprint
-from datetime import datetime
 from billiard.process import current_process
-from django.core.exceptions import ObjectDoesNotExist
-from accountant.methods import datetime_directive_ccxt, dt_aware_now
+from accountant.methods import dt_aware_now, get_redis
 from accountant.celery import app
-from account.models import Account, Order, Trade, Balance
+from django.conf import settings
+from account.models import Account, Order, Balance, BalanceRollup, SyncCursor
+from account.methods import create_trades, create_update_orders, get_cursor, get_trades_cursor, fetch_pages, \
+    fetch_pages_async, to_timestamp, select_symbols, is_sweep_due, mark_sweep, update_rollups, truncate
+from accountant.cache import bump_account_version
+from market.writer import DatabaseWriter
 from market.models import Market
 from pnl.tasks import update_inventories
 from celery import chord, chain, group
+import asyncio
+import hashlib
+import json
 import structlog
 import ccxt
 from celery.utils.log import get_task_logger
@@ -23,79 +28,43 @@ log = structlog.wrap_logger(get_task_logger(__name__))
 @app.task(bind=True, name='Account______Fetch orders')
 def fetch_orders(self, pk):
     """
-    Fetch orders history
+    Fetch orders history page by page from the cursor of each wallet
     """
     account = Account.objects.get(pk=pk)
-    # log = logger.bind(account=account.name)
-
-    if self.request.id:
-        pass
-        # log.bind(worker=current_process().index, task=self.request.id[:3])
-
-    # Determine start datetime
-    qs = Order.objects.filter(account=account)
-    start_datetime = qs.latest('datetime').datetime if qs else account.dt_created
-    start_datetime = int(start_datetime.timestamp())
-    params = dict(start_datetime=start_datetime)
-
-    # log.bind(start_datetime=start_datetime)
     log.info('Fetch orders {0}'.format(account.name))
 
-    def create_update_order(dic, wallet=None):
-
-        try:
-            market = Market.objects.get(exchange=account.exchange, wallet=wallet, symbol=dic['symbol'])
+    def select_markets(wallet=None):
+        return dict(Market.objects.filter(exchange=account.exchange, wallet=wallet).values_list('symbol', 'id'))
 
-        except ObjectDoesNotExist:
-            pass
+    def get_start(wallet=None):
+        # Start from the latest order in database when the cursor is created
+        qs = Order.objects.filter(account=account, market__wallet=wallet)
+        return to_timestamp(qs.latest('datetime').datetime if qs.exists() else account.dt_created)
 
-        else:
+    def pending(page):
+        # Orders still open can be updated, they are fetched again on the next run
+        return min((dic['timestamp'] for dic in page if dic['status'] == 'open'), default=None)
 
-            if dic['datetime']:
-                dt = datetime.strptime(dic['datetime'], datetime_directive_ccxt).replace(tzinfo=pytz.UTC)
-            else:
-                dt = None
-
-            defaults = dict(
-                amount=dic['amount'],
-                average=dic['average'],
-                clientid=dic['clientOrderId'],
-                cost=dic['cost'],
-                datetime=dt,
-                fee=dic['fee'],
-                fees=dic['fees'],
-                filled=dic['filled'],
-                info=dic['info'],
-                market=market,
-                price=dic['price'],
-                remaining=dic['remaining'],
-                side=dic['side'],
-                status=dic['status'],
-                trades=dic['trades'],
-                type=dic['type'],
-            )
-
-            Order.objects.update_or_create(orderid=dic['id'],
-                                           account=account,
-                                           defaults=defaults
-                                           )
+    def fetch(client, wallet=None):
+        markets = select_markets(wallet)
+        cursor = get_cursor(account, SyncCursor.Stream.ORDERS, wallet, since=get_start(wallet))
+        n = fetch_pages(lambda since, limit: client.fetchOrders(since=since, limit=limit),
+                        lambda page: sum(create_update_orders(account, page, markets)),
+                        cursor,
+                        settings.HISTORY_PAGE_LIMIT,
+                        pending)
+        log.info('Fetch orders', written=n, wallet=wallet, since=cursor.since)
 
     try:
 
         client = account.exchange.get_ccxt_client(account)
         wallets = account.exchange.get_wallets()
         if wallets:
-
             for wallet in wallets:
                 client.options['defaultType'] = wallet
-                response = client.fetchOrders(params=params)
-                for dic in response:
-                    create_update_order(dic, wallet=wallet)
-
+                fetch(client, wallet)
         else:
-            response = client.fetchOrders(params=params)
-            for dic in response:
-                create_update_order(dic)
+            fetch(client)
 
     except ccxt.RequestTimeout as e:
         log.error('Fetch orders failure', cause='timeout')
@@ -115,86 +84,36 @@ def fetch_orders(self, pk):
 @app.task(bind=True, name='Account______Fetch trades')
 def fetch_trades(self, pk):
     """
-    Fetch trades history
+    Fetch trades history page by page from the cursor of each symbol
     """
     account = Account.objects.get(pk=pk)
-    # log = logger.bind(account=account.name)
-
-    if self.request.id:
-        pass
-        # log.bind(worker=current_process().index, task=self.request.id[:3])
-
-    # Determine start datetime
-    qs = Trade.objects.filter(account=account)
-    start_datetime = qs.latest('datetime').datetime if qs else account.dt_created
-    start_datetime = int(start_datetime.timestamp() * 1000)
-
-    # log.bind(start_datetime=start_datetime)
     log.info('Fetch trades {0}'.format(account.name))
 
-    def create_trade(dic):
-
-        if dic['order']:
-            try:
-                order = Order.objects.get(orderid=dic['order'])
-            except ObjectDoesNotExist:
-                order = None
-        else:
-            order = None
-
-        if dic['datetime']:
-            dt = datetime.strptime(dic['datetime'], datetime_directive_ccxt).replace(tzinfo=pytz.UTC)
-        else:
-            dt = None
-
-        defaults = dict(
-            amount=dic['amount'],
-            cost=dic['cost'],
-            datetime=dt,
-            fee=dic['fee'],
-            fees=dic['fees'],
-            info=dic['info'],
-            order=order,
-            price=dic['price'],
-            side=dic['side'],
-            symbol=dic['symbol'],
-            taker_or_maker=dic['takerOrMaker'],
-            timestamp=dic['timestamp'],
-            type=dic['type']
-        )
-
-        obj, created = Trade.objects.update_or_create(tradeid=dic['id'],
-                                                      account=account,
-                                                      symbol=dic['symbol'],
-                                                      defaults=defaults
-                                                      )
-        if created:
-            log.info('Trade object created')
+    def fetch(client, symbol, wallet=None):
+        cursor = get_trades_cursor(account, symbol, wallet)
+        n = fetch_pages(lambda since, limit: client.fetchMyTrades(symbol, since=since, limit=limit),
+                        lambda page: create_trades(account, page),
+                        cursor,
+                        settings.HISTORY_PAGE_LIMIT)
+        log.info('Fetch trades', created=n, wallet=wallet, symbol=symbol)
 
     try:
 
         client = account.exchange.get_ccxt_client(account)
         wallets = account.exchange.get_wallets()
-        qs = Market.objects.filter(exchange=account.exchange).values_list('symbol', flat=True)
+        sweep = is_sweep_due(account)
 
         if wallets:
-
             for wallet in wallets:
                 client.options['defaultType'] = wallet
-                symbols = (qs.filter(wallet=wallet))
-                for symbol in symbols:
-                    response = client.fetchMyTrades(symbol, since=start_datetime)
-                    log.info('Fetch trades')  # , length=len(response), wallet=wallet, symbol=symbol)
-                    for dic in response:
-                        create_trade(dic)
-
+                for symbol in select_symbols(account, wallet, sweep):
+                    fetch(client, symbol, wallet)
         else:
-            symbols = list(qs)
-            for symbol in symbols:
-                response = client.fetchMyTrades(symbol, since=start_datetime)
-                log.info('Fetch trades')  # , length=len(response), symbol=symbol)
-                for dic in response:
-                    create_trade(dic)
+            for symbol in select_symbols(account, sweep=sweep):
+                fetch(client, symbol)
+
+        if sweep:
+            mark_sweep(account)
 
     except ccxt.RequestTimeout as e:
         log.error('Fetch trades failure', cause='timeout')
@@ -205,17 +124,157 @@ def fetch_trades(self, pk):
         raise self.retry(exc=e)
 
     except Exception as e:
-        # log.exception('Fetch trades failure', cause=str(e))
         log.exception('Fetch trades failure')
 
     else:
         log.info('Fetch trades complete')
 
 
+@app.task(bind=True, name='Account______Fetch trades async')
+def fetch_trades_async(self, pk):
+    """
+    Fetch trades history of all symbols and wallets concurrently with ccxt async support
+    """
+    account = Account.objects.get(pk=pk)
+    log.info('Fetch trades async {0}'.format(account.name))
+
+    def select_cursors():
+        wallets = account.exchange.get_wallets() or [None]
+        return [(wallet, get_trades_cursor(account, symbol, wallet))
+                for wallet in wallets
+                for symbol in select_symbols(account, wallet, sweep)]
+
+    async def main():
+
+        writer = DatabaseWriter(maxsize=settings.DATABASE_WRITER_QUEUE_SIZE)
+        task = asyncio.ensure_future(writer.run())
+        clients = dict()
+
+        try:
+            lst = await writer.call(select_cursors)
+            for wallet in {wallet for wallet, cursor in lst}:
+                clients[wallet] = account.exchange.get_ccxt_client_async(account, wallet)
+                await clients[wallet].load_markets()
+
+            if not clients:
+                return []
+
+            # Keep at most one second of requests in flight, clients also throttle their own requests
+            rate_limit = max(client.rateLimit for client in clients.values())
+            semaphore = asyncio.Semaphore(max(1, int(1000 / rate_limit)))
+
+            async def symbol_loop(wallet, cursor):
+
+                async def fetch(since, limit):
+                    async with semaphore:
+                        return await clients[wallet].fetch_my_trades(cursor.symbol, since=since, limit=limit)
+
+                n = await fetch_pages_async(fetch,
+                                            lambda page: create_trades(account, page),
+                                            cursor,
+                                            settings.HISTORY_PAGE_LIMIT,
+                                            writer)
+                log.info('Fetch trades', created=n, wallet=wallet, symbol=cursor.symbol)
+
+            # A failed symbol doesn't stop the others, its cursor holds the last committed page
+            return await asyncio.gather(*[symbol_loop(wallet, cursor) for wallet, cursor in lst],
+                                        return_exceptions=True)
+
+        finally:
+            await writer.join()
+            log.info('Database writer', **writer.stats())
+            task.cancel()
+            await writer.close()
+            for client in clients.values():
+                await client.close()
+
+    try:
+
+        sweep = is_sweep_due(account)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            results = loop.run_until_complete(main())
+        finally:
+            loop.close()
+
+        errors = [e for e in results if isinstance(e, Exception)]
+        for e in errors:
+            log.error('Fetch trades failure', cause=str(e))
+
+        # Retry once all symbols are done, fetch resumes from cursors
+        network = [e for e in errors if isinstance(e, ccxt.NetworkError)]
+        if network:
+            raise network[0]
+
+        if sweep and not errors:
+            mark_sweep(account)
+
+    except ccxt.NetworkError as e:
+        log.error('Fetch trades failure', cause=str(e))
+        raise self.retry(exc=e)
+
+    except Exception as e:
+        log.exception('Fetch trades failure')
+
+    else:
+        log.info('Fetch trades complete')
+
+
+@app.task(bind=True, name='Account______Backfill rollups')
+def backfill_rollups(self, pk):
+    """
+    Build hourly and daily rollups from the balances history of an account
+    """
+    account = Account.objects.get(pk=pk)
+    qs = Balance.objects.filter(account=account).only('id', 'account_id', 'dt', 'assets_total_value', 'assets',
+                                                      'assets_value').order_by('dt')
+
+    chunk, created, updated = [], 0, 0
+    for obj in qs.iterator(chunk_size=settings.INVENTORY_CHUNK_SIZE):
+        chunk.append(obj)
+        if len(chunk) == settings.INVENTORY_CHUNK_SIZE:
+            c, u = update_rollups(chunk)
+            created, updated, chunk = created + c, updated + u, []
+
+    c, u = update_rollups(chunk)
+    bump_account_version(pk)
+    log.info('Backfill rollups complete', account=account.name, created=created + c, updated=updated + u)
+
+
+@app.task(bind=True, name='Account______Bulk Backfill rollups')
+def bulk_backfill_rollups(self):
+    group(backfill_rollups.si(account.pk) for account in Account.objects.all()).delay()
+
+
+def schedule_backfill_rollups(account):
+    """
+    Schedule a rollups backfill of an account with balances older than its first daily rollup, such as balances
+    saved before rollups existed. Return True if a backfill is scheduled
+    """
+    oldest = Balance.objects.filter(account=account).order_by('dt').values_list('dt', flat=True).first()
+    if oldest is None:
+        return False
+
+    first = BalanceRollup.objects.filter(account=account,
+                                         resolution=BalanceRollup.Resolution.DAY
+                                         ).order_by('bucket').values_list('bucket', flat=True).first()
+    if first is not None and first <= truncate(oldest, BalanceRollup.Resolution.DAY):
+        return False
+
+    r = get_redis(settings.CELERY_BROKER_URL)
+    if r.set('account:rollups:backfill:{0}'.format(account.pk), 1, nx=True, ex=settings.ROLLUP_BACKFILL_TTL):
+        backfill_rollups.delay(account.pk)
+        return True
+    return False
+
+
 @app.task(bind=True, name='Account______Update inventory')
 def update_inventory(self, pk):
+    # Saves received from now on schedule a new update
+    get_redis(settings.CELERY_BROKER_URL).delete('account:sync:pending:{0}'.format(pk))
     chord(fetch_orders.si(pk),
-          fetch_trades.si(pk)
+          fetch_trades_async.si(pk)
           )(update_inventories.si(pk))
 
 
@@ -225,7 +284,38 @@ def bulk_update_inventory(self):
         pk = account.pk
         chord(
             chain(fetch_orders.si(pk),
-                  fetch_trades.si(pk))
+                  fetch_trades_async.si(pk))
         )(
             update_inventories.si(pk)
         )
+
+
+def schedule_update_inventory(pk, assets=None):
+    """
+    Schedule an inventory update of an account in SYNC_DEBOUNCE seconds, updates requested while one is
+    pending are coalesced and requests with unchanged assets are skipped. Return True if an update is scheduled
+    """
+    r = get_redis(settings.CELERY_BROKER_URL)
+    metrics = 'account:sync:metrics:{0}'.format(pk)
+
+    if assets is not None:
+        digest = hashlib.sha1(json.dumps(assets, sort_keys=True, default=str).encode()).hexdigest()
+        if r.getset('account:sync:assets:{0}'.format(pk), digest) == digest:
+            r.hincrby(metrics, 'skipped')
+            return False
+
+    if r.set('account:sync:pending:{0}'.format(pk), 1, nx=True, ex=settings.SYNC_PENDING_TTL):
+        update_inventory.apply_async(args=[pk], countdown=settings.SYNC_DEBOUNCE)
+        r.hincrby(metrics, 'scheduled')
+        return True
+
+    r.hincrby(metrics, 'coalesced')
+    return False
+
+
+def get_sync_metrics(pk):
+    """
+    Return the number of inventory updates scheduled, coalesced and skipped of an account
+    """
+    metrics = get_redis(settings.CELERY_BROKER_URL).hgetall('account:sync:metrics:{0}'.format(pk))
+    return {key: int(metrics.get(key, 0)) for key in ['scheduled', 'coalesced', 'skipped']}
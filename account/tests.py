@@ -1,3 +1,118 @@
+import asyncio
 from django.test import TestCase
+from account.methods import advance_page, fetch_pages, fetch_pages_async
 
-# Create your tests here.
+
+class Exchange:
+    """
+    Fake exchange returning pages of trades from a since, optionally ignoring it
+    """
+
+    def __init__(self, timestamps, ignore_since=False):
+        self.rows = [dict(id=str(i), timestamp=t) for i, t in enumerate(timestamps)]
+        self.ignore_since = ignore_since
+        self.calls = []
+
+    def fetch(self, since, limit):
+        self.calls.append(since)
+        rows = self.rows if self.ignore_since or since is None else [r for r in self.rows if r['timestamp'] >= since]
+        return rows[:limit]
+
+
+class Cursor:
+    stream, symbol = 'trades', 'BTC/USDT'
+
+    def __init__(self, since=None):
+        self.since = since
+        self.saves = 0
+
+    def save(self):
+        self.saves += 1
+
+
+class Store:
+    """
+    Ingest objects once, as create_trades() does
+    """
+
+    def __init__(self):
+        self.ids = []
+
+    def ingest(self, page):
+        new = [dic['id'] for dic in page if dic['id'] not in self.ids]
+        self.ids.extend(new)
+        return len(new)
+
+
+class Writer:
+
+    async def call(self, fn, *args):
+        return fn(*args)
+
+
+class AdvancePageTestCase(TestCase):
+
+    def test_latest_millisecond(self):
+        page = [dict(id='1', timestamp=1), dict(id='2', timestamp=3)]
+        self.assertEqual(advance_page(page, set()), (3, None, 3))
+
+    def test_seen(self):
+        page = [dict(id='1', timestamp=1), dict(id='2', timestamp=3)]
+        self.assertIsNone(advance_page(page, {'1', '2'}))
+        self.assertIsNotNone(advance_page(page, {'1'}))
+
+    def test_pending(self):
+        # Open objects hold the persisted since, the next page still starts at the latest millisecond
+        page = [dict(id='1', timestamp=1, status='closed'), dict(id='2', timestamp=2, status='open'),
+                dict(id='3', timestamp=5, status='closed')]
+
+        def pending(page):
+            return min((dic['timestamp'] for dic in page if dic['status'] == 'open'), default=None)
+
+        self.assertEqual(advance_page(page, set(), None, pending), (5, 2, 2))
+
+
+class FetchPagesTestCase(TestCase):
+
+    def fetch(self, exchange, cursor, store, limit):
+        return fetch_pages(exchange.fetch, store.ingest, cursor, limit)
+
+    def test_millisecond_ties(self):
+        # Trades sharing a millisecond continue on the next page
+        exchange, cursor, store = Exchange([1, 2, 3, 3, 3, 4, 4, 4, 5]), Cursor(), Store()
+        self.assertEqual(self.fetch(exchange, cursor, store, 4), 9)
+        self.assertEqual(sorted(store.ids, key=int), [str(i) for i in range(9)])
+        self.assertEqual(cursor.since, 5)
+
+    def test_full_page_of_a_millisecond(self):
+        # Trades of a millisecond beyond a full page can't be paged through, the cursor skips it
+        exchange, cursor, store = Exchange([1, 2, 2, 2, 2, 2, 3]), Cursor(), Store()
+        self.assertEqual(self.fetch(exchange, cursor, store, 4), 6)
+        self.assertIn('6', store.ids)
+        self.assertEqual(cursor.since, 3)
+
+    def test_up_to_date(self):
+        # A run over an up-to-date cursor requests the tail once and doesn't write the cursor
+        exchange, cursor, store = Exchange([1, 2, 3, 3]), Cursor(), Store()
+        self.fetch(exchange, cursor, store, 4)
+        exchange.calls, cursor.saves = [], 0
+
+        self.assertEqual(self.fetch(exchange, cursor, store, 4), 0)
+        self.assertEqual(exchange.calls, [3])
+        self.assertEqual(cursor.saves, 0)
+
+    def test_since_ignored(self):
+        # An exchange returning the same page whatever the since doesn't loop forever
+        exchange, cursor, store = Exchange(range(1, 11), ignore_since=True), Cursor(), Store()
+        self.assertEqual(self.fetch(exchange, cursor, store, 4), 4)
+        self.assertEqual(len(exchange.calls), 2)
+
+    def test_async(self):
+        exchange, cursor, store = Exchange([1, 2, 3, 3, 3, 4, 4, 4, 5]), Cursor(), Store()
+
+        async def fetch(since, limit):
+            return exchange.fetch(since, limit)
+
+        n = asyncio.run(fetch_pages_async(fetch, store.ingest, cursor, 4, Writer()))
+        self.assertEqual(n, 9)
+        self.assertEqual(cursor.since, 5)
@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework import routers
-from account.api.views import AccountViewSet, BalanceViewSet
+from account.api.views import AccountViewSet, BalanceViewSet, BalanceBulkViewSet, SyncMetricsViewSet, TradeViewSet, ExportViewSet
 from account.api.widgets.summary.views import *
 from account.api.widgets.futures.views import *
 
@@ -11,6 +11,11 @@ router.register('balance', BalanceViewSet, basename="balances-list")
 
 urlpatterns = [
     path('', include(router.urls)),
+    path('balances/bulk/', BalanceBulkViewSet.as_view()),
+    path('account/<int:account_id>/sync_metrics/', SyncMetricsViewSet.as_view()),
+    path('account/<int:account_id>/trades/', TradeViewSet.as_view()),
+    path('account/<int:account_id>/export/<str:name>/', ExportViewSet.as_view()),
+    path('account/<int:account_id>/summary/', DashboardViewSet.as_view()),
     path('account/<int:account_id>/summary/assets/', AssetsViewSet.as_view()),
     path('account/<int:account_id>/summary/assets_value/', AssetsValueViewSet.as_view()),
     path('account/<int:account_id>/summary/assets_growth/', AssetsGrowthViewSet.as_view()),
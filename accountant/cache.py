@@ -0,0 +1,72 @@
+from functools import wraps
+from urllib.parse import urlencode
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import QuerySet
+from rest_framework.response import Response
+import structlog
+
+log = structlog.get_logger(__name__)
+
+
+def get_version(name):
+    """
+    Return the version of a data set
+    """
+    return cache.get_or_set('version:' + name, 1, timeout=None)
+
+
+def bump_version(name):
+    """
+    Increment the version of a data set so cached responses computed from it are no longer served
+    """
+    key = 'version:' + name
+    cache.add(key, 1, timeout=None)
+    return cache.incr(key)
+
+
+def bump_account_version(pk):
+    return bump_version('account:{0}'.format(pk))
+
+
+def is_shared():
+    """
+    Return True if the cache backend is shared between processes
+    """
+    return 'locmem' not in settings.CACHES['default']['BACKEND'].lower()
+
+
+def cached_response(*names):
+    """
+    Cache responses of a widget get() method by view, account, query parameters and versions of the account
+    data and of the shared data sets named, 'tickers' or 'prices', the response depends on
+    """
+    def decorator(method):
+
+        @wraps(method)
+        def wrapper(self, request, account_id):
+
+            if not is_shared():
+                return method(self, request, account_id)
+
+            versions = [get_version(name) for name in ['account:{0}'.format(account_id)] + list(names)]
+
+            key = 'widget:{0}:{1}:{2}:{3}'.format(type(self).__name__,
+                                                   account_id,
+                                                   urlencode(sorted(request.GET.items())),
+                                                   ':'.join(str(v) for v in versions))
+            data = cache.get(key)
+            if data is not None:
+                return Response(data)
+
+            response = method(self, request, account_id)
+            if response.status_code == 200:
+                data = list(response.data) if isinstance(response.data, QuerySet) else response.data
+                cache.set(key, data, settings.WIDGET_CACHE_TIMEOUT)
+                return Response(data)
+
+            return response
+
+        return wrapper
+
+    return decorator
@@ -1,6 +1,9 @@
 from datetime import datetime, timezone, timedelta
 import os, environ, pytz
+import redis
 import structlog
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 
 log = structlog.get_logger(__name__)
 
@@ -17,6 +20,28 @@ def get_env():
     return env
 
 
+_redis_clients = dict()
+
+
+def get_redis(url):
+    """
+    Return a Redis client, connections are pooled per URL
+    """
+    if url not in _redis_clients:
+        _redis_clients[url] = redis.Redis.from_url(url, decode_responses=True)
+    return _redis_clients[url]
+
+
+def send_event(group, event):
+    """
+    Send an event to a group of the channel layer, a failure doesn't interrupt the caller
+    """
+    try:
+        async_to_sync(get_channel_layer().group_send)(group, dict(type=event))
+    except Exception as e:
+        log.error('Event not sent', group=group, event=event, cause=str(e))
+
+
 def to_datetime(obj):
     if isinstance(int, obj):
         return datetime.fromtimestamp(obj).replace(tzinfo=pytz.UTC)
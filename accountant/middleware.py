@@ -0,0 +1,31 @@
+from urllib.parse import parse_qs
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.contrib.auth import get_user_model
+import structlog
+
+log = structlog.get_logger(__name__)
+
+
+@database_sync_to_async
+def get_token_user(token):
+    from rest_framework_simplejwt.tokens import AccessToken
+    from rest_framework_simplejwt.exceptions import TokenError
+    try:
+        return get_user_model().objects.get(pk=AccessToken(token)['user_id'])
+    except (TokenError, KeyError, get_user_model().DoesNotExist):
+        log.warning('Websocket token rejected')
+
+
+class TokenAuthMiddleware(BaseMiddleware):
+    """
+    Authenticate websockets with a JWT access token passed as token query parameter, like the REST API
+    """
+
+    async def __call__(self, scope, receive, send):
+        token = parse_qs(scope.get('query_string', b'').decode()).get('token')
+        if token:
+            user = await get_token_user(token[0])
+            if user:
+                scope = dict(scope, user=user)
+        return await super().__call__(scope, receive, send)
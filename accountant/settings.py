@@ -34,6 +34,7 @@ INSTALLED_APPS = [
     'django_filters',
     'drf_spectacular',
     'admincharts',
+    'channels',
 ]
 
 MIDDLEWARE = [
@@ -124,6 +125,63 @@ CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
 CELERY_IMPORTS = ('authentication.tasks', 'pnl.tasks', 'statistic.tasks', 'account.tasks', 'market.tasks')
 
+# Ticker cache backend 'local' (process memory) or 'redis', flushed to database every n seconds
+TICKER_CACHE_BACKEND = os.environ.get('TICKER_CACHE_BACKEND', 'local')
+TICKER_CACHE_URL = os.environ.get('TICKER_CACHE_URL', CELERY_BROKER_URL)
+TICKER_FLUSH_INTERVAL = 5
+
+# Seconds a resolved market is served from the process cache of market.methods.get_market()
+MARKET_CACHE_TTL = 60
+
+# Trades read and Inventory objects written per batch when inventories are updated
+INVENTORY_CHUNK_SIZE = 2000
+
+# Maximum number of trades and orders requested per page when the history is fetched
+HISTORY_PAGE_LIMIT = 1000
+
+# Symbols always fetched and interval (hours) of the sweep fetching trades of every market of the exchange
+FETCH_TRADES_SYMBOLS = []
+FETCH_TRADES_SWEEP_INTERVAL = 24 * 7
+
+# Seconds a balance update waits for others before the inventory of the account is updated, and expiration
+# of the pending flag if the scheduled update is lost
+SYNC_DEBOUNCE = 30
+SYNC_PENDING_TTL = 600
+
+# Periods of up to n days are charted from hourly balance rollups, longer periods from daily rollups
+ROLLUP_HOURLY_MAX_DAYS = 7
+
+# Seconds before a charted account whose balances predate its rollups can schedule another rollups backfill
+ROLLUP_BACKFILL_TTL = 3600
+
+# Cache of widget responses, shared through Redis with the workers that write data. Entries are invalidated by data
+# versions, the timeout only bounds memory. An empty CACHE_URL selects process memory and disables widget caching
+# since versions bumped by workers wouldn't be seen
+CACHE_URL = os.environ.get('CACHE_URL', CELERY_BROKER_URL)
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+                'LOCATION': CACHE_URL} if CACHE_URL else
+               {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+}
+WIDGET_CACHE_TIMEOUT = 3600
+
+# Channel layer of live account updates, shared through Redis with the ticker collector and workers. CHANNEL_LAYER_URL
+# 'memory' selects an in-memory layer for tests. Updates are pushed to a client at most every n seconds
+CHANNEL_LAYER_URL = os.environ.get('CHANNEL_LAYER_URL', CELERY_BROKER_URL)
+CHANNEL_LAYERS = {
+    'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'} if CHANNEL_LAYER_URL == 'memory' else
+               {'BACKEND': 'channels_redis.core.RedisChannelLayer',
+                'CONFIG': {'hosts': [CHANNEL_LAYER_URL]}}
+}
+LIVE_UPDATES_THROTTLE = 1
+
+# Rows fetched per server-side cursor round trip and written per Parquet/Feather batch by exports
+EXPORT_CHUNK_SIZE = 5000
+
+# Websocket collector database writer, maximum queued writes and stats logging interval (seconds)
+DATABASE_WRITER_QUEUE_SIZE = 100
+DATABASE_WRITER_STATS_INTERVAL = 60
+
 en_formats.DATETIME_FORMAT = 'Y-m-d H:i:s'
 DATA_UPLOAD_MAX_NUMBER_FIELDS = 10240
 
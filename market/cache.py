@@ -0,0 +1,115 @@
+import json
+import threading
+from datetime import datetime
+from django.conf import settings
+from accountant.methods import get_redis
+import structlog
+
+log = structlog.get_logger(__name__)
+
+
+class LocalTickerCache:
+    """
+    Hold the latest ticker of each market in process memory. Tickers are set by the event loop and popped
+    by the database writer thread
+    """
+
+    def __init__(self):
+        self.tickers = dict()
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    def set(self, pk, response):
+        ticker = dict(timestamp=int(datetime.utcnow().timestamp()),
+                      last=response['last'],
+                      response=response)
+        with self.lock:
+            self.tickers[pk] = ticker
+            self.dirty.add(pk)
+
+    def get(self, pk):
+        return self.tickers.get(pk)
+
+    def pop_dirty(self):
+        """
+        Return tickers updated since the previous call
+        """
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            return {pk: self.tickers[pk] for pk in dirty}
+
+
+class RedisTickerCache:
+    """
+    Hold the latest ticker of each market in Redis so they are shared between processes. Tickers are
+    buffered in memory by set() so the event loop never waits for Redis, and written by the next pop_dirty()
+    """
+    key = 'market:tickers'
+    key_dirty = 'market:tickers:dirty'
+
+    def __init__(self, url):
+        self.redis = get_redis(url)
+        self.pending = dict()
+        self.lock = threading.Lock()
+
+    def set(self, pk, response):
+        ticker = dict(timestamp=int(datetime.utcnow().timestamp()),
+                      last=response['last'],
+                      response=response)
+        with self.lock:
+            self.pending[pk] = ticker
+
+    def get(self, pk):
+        ticker = self.pending.get(pk)
+        if ticker:
+            return ticker
+
+        ticker = self.redis.hget(self.key, pk)
+        if ticker:
+            return json.loads(ticker)
+
+    def push(self):
+        """
+        Write buffered tickers to Redis
+        """
+        with self.lock:
+            pending, self.pending = self.pending, dict()
+
+        if pending:
+            pipe = self.redis.pipeline()
+            pipe.hset(self.key, mapping={pk: json.dumps(ticker, default=str) for pk, ticker in pending.items()})
+            pipe.sadd(self.key_dirty, *pending.keys())
+            pipe.execute()
+
+    def pop_dirty(self):
+        """
+        Return tickers updated since the previous call
+        """
+        self.push()
+
+        pipe = self.redis.pipeline()
+        pipe.smembers(self.key_dirty)
+        pipe.delete(self.key_dirty)
+        dirty = [int(pk) for pk in pipe.execute()[0]]
+        if not dirty:
+            return dict()
+
+        tickers = self.redis.hmget(self.key, dirty)
+        return {pk: json.loads(ticker) for pk, ticker in zip(dirty, tickers) if ticker}
+
+
+_cache = None
+
+
+def get_ticker_cache():
+    """
+    Return the ticker cache of the backend selected in settings
+    """
+    global _cache
+    if _cache is None:
+        if settings.TICKER_CACHE_BACKEND == 'redis':
+            _cache = RedisTickerCache(settings.TICKER_CACHE_URL)
+        else:
+            _cache = LocalTickerCache()
+        log.info('Ticker cache initialized', backend=settings.TICKER_CACHE_BACKEND)
+    return _cache
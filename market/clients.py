@@ -0,0 +1,118 @@
+import asyncio
+import ccxt.pro
+import structlog
+
+log = structlog.get_logger(__name__)
+
+
+class ClientRegistry:
+    """
+    Share one ccxt.pro client per (exid, wallet) between websocket streams
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.clients = dict()
+        self.references = dict()
+        self.pending = dict()
+        self.lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self.clients)
+
+    async def create(self, exid, wallet=None):
+        """
+        Return a new client of (exid, wallet) with its markets loaded
+        """
+        client = getattr(ccxt.pro, exid)
+        client = client(dict(enableRateLimit=True,
+                             asyncio_loop=self.loop,
+                             newUpdates=True
+                             ))
+
+        if wallet:
+            if 'defaultType' in client.options:
+                client.options['defaultType'] = wallet
+
+        try:
+            await client.load_markets()
+        except Exception:
+            await client.close()
+            raise
+
+        return client
+
+    async def acquire(self, exid, wallet=None):
+        """
+        Return the client of (exid, wallet), create it and load markets on first use. Markets are loaded
+        outside the lock so clients of other keys are served meanwhile, and concurrent streams of the same key
+        wait for the first one to create the client
+        """
+        key = (exid, wallet)
+        async with self.lock:
+            if key in self.clients:
+                self.references[key] += 1
+                return self.clients[key]
+
+            future = self.pending.get(key)
+            if future is None:
+                future = self.pending[key] = self.loop.create_future()
+                creator = True
+            else:
+                creator = False
+
+        if not creator:
+            # Acquire the created client, or create it again if it was closed in between
+            await asyncio.shield(future)
+            return await self.acquire(exid, wallet)
+
+        try:
+            client = await self.create(exid, wallet)
+
+        except Exception as e:
+            async with self.lock:
+                del self.pending[key]
+            future.set_exception(e)
+            future.exception()  # Waiters are optional, don't log the exception as never retrieved
+            raise
+
+        async with self.lock:
+            del self.pending[key]
+            self.clients[key] = client
+            self.references[key] = 1
+            log.info('Client created', exid=exid, wallet=wallet)
+
+        future.set_result(None)
+        return client
+
+    async def release(self, exid, wallet=None):
+        """
+        Decrement references to the client of (exid, wallet) and close it when unused
+        """
+        key = (exid, wallet)
+        async with self.lock:
+            if key not in self.clients:
+                return
+
+            self.references[key] -= 1
+            if self.references[key] <= 0:
+                client = self.clients.pop(key)
+                del self.references[key]
+                await client.close()
+                log.info('Client closed', exid=exid, wallet=wallet)
+
+    async def close(self):
+        """
+        Close all clients regardless of their references
+        """
+        async with self.lock:
+            for (exid, wallet), client in self.clients.items():
+                try:
+                    await client.close()
+                except Exception as e:
+                    log.error('Client closure failure', exid=exid, wallet=wallet, cause=str(e))
+                else:
+                    log.info('Client closed', exid=exid, wallet=wallet)
+
+            self.clients.clear()
+            self.references.clear()
@@ -1,18 +1,53 @@
+import time
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
-from datetime import datetime
-from market.models import Market
+from accountant.methods import dt_aware_now, send_event
+from accountant.cache import bump_version
+from market.cache import get_ticker_cache
+from market.models import Market, Price
 import structlog
 log = structlog.get_logger(__name__)
 
 
+# Resolved markets and the time of resolution, keyed by (exchange, type, wallet, base, quote, symbol)
+_markets = dict()
+
+
 def get_market(exchange, tp=None, base=None, quote=None, symbol=None, wallet=None):
+    """
+    Return (market, flip) from cache or database, None if market doesn't exist
+    """
+    key = (exchange.pk, tp, wallet, base, quote, symbol)
+    if key in _markets and time.monotonic() - _markets[key][1] < settings.MARKET_CACHE_TTL:
+        result = _markets[key][0]
+
+    else:
+        result = resolve_market(exchange, tp, base, quote, symbol, wallet)
+        _markets[key] = (result, time.monotonic())
+
+        # Remember the direct lookup of a flipped market
+        if result and result[1]:
+            _markets[(exchange.pk, tp, wallet, quote, base, symbol)] = ((result[0], False), time.monotonic())
+
+    if symbol and not result:
+        raise Market.DoesNotExist('Market matching query does not exist.')
+
+    return result
+
+
+def resolve_market(exchange, tp=None, base=None, quote=None, symbol=None, wallet=None):
 
     if symbol:
-        if wallet:
-            obj = Market.objects.get(exchange=exchange, symbol=symbol, wallet=wallet)
+        try:
+            if wallet:
+                obj = Market.objects.get(exchange=exchange, symbol=symbol, wallet=wallet)
+            else:
+                obj = Market.objects.get(exchange=exchange, symbol=symbol)
+
+        except ObjectDoesNotExist:
+            log.info('Market not found')
         else:
-            obj = Market.objects.get(exchange=exchange, symbol=symbol)
-        return obj, False
+            return obj, False
 
     elif base and quote and (tp or wallet):
         if isinstance(base, str) and isinstance(quote, str):
@@ -45,12 +80,80 @@ def get_market(exchange, tp=None, base=None, quote=None, symbol=None, wallet=Non
         log.error('Unable to select market')
 
 
-def save_ticker_price(market, response, freq):
-    ts = int(datetime.utcnow().timestamp())
-    if 'timestamp' in market.ticker:
-        if ts > market.ticker['timestamp'] + freq:
-            market.ticker = dict(timestamp=ts, last=response['last'])
-            market.save()
+def clear_markets_cache(exchange=None):
+    """
+    Forget resolved markets of an exchange, or all of them
+    """
+    if exchange:
+        for key in [k for k in _markets.keys() if k[0] == exchange.pk]:
+            del _markets[key]
     else:
-        market.ticker = dict(timestamp=ts, last=response['last'])
-        market.save()
\ No newline at end of file
+        _markets.clear()
+
+
+def get_last_price(market):
+    """
+    Return the latest price of a market from the ticker cache, or from its ticker field
+    """
+    ticker = get_ticker_cache().get(market.pk)
+    if ticker:
+        return ticker['last']
+    return market.ticker['last']
+
+
+def get_last_prices(pks):
+    """
+    Return the latest price of markets from the ticker cache, or from their ticker field with a single query
+    """
+    cache = get_ticker_cache()
+    prices = dict()
+    for pk in pks:
+        ticker = cache.get(pk)
+        if ticker:
+            prices[pk] = ticker['last']
+
+    missing = [pk for pk in pks if pk not in prices]
+    if missing:
+        for pk, ticker in Market.objects.filter(pk__in=missing).values_list('pk', 'ticker'):
+            prices[pk] = ticker.get('last') if ticker else None
+
+    return prices
+
+
+# Markets with a Price object at the datetime
+_priced = dict()
+
+
+def flush_tickers(cache):
+    """
+    Write tickers updated since the previous flush to Market and create the missing daily Price
+    """
+    tickers = cache.pop_dirty()
+    if not tickers:
+        return 0
+
+    # Update tickers without selecting markets
+    markets = [Market(pk=pk, ticker=dict(timestamp=ticker['timestamp'], last=ticker['last']))
+               for pk, ticker in tickers.items()]
+    Market.objects.bulk_update(markets, ['ticker'])
+
+    # Create Price objects of markets not priced yet today, (market, dt) is unique
+    dt = dt_aware_now()
+    missing = [pk for pk in tickers.keys() if _priced.get(pk) != dt]
+    if missing:
+        prices = [Price(market_id=pk,
+                        response=tickers[pk]['response'],
+                        dt=dt,
+                        last=tickers[pk]['last']
+                        ) for pk in missing]
+        Price.objects.bulk_create(prices, ignore_conflicts=True)
+        log.info('Price objects created', n=len(prices))
+
+        for pk in missing:
+            _priced[pk] = dt
+
+        bump_version('prices')
+
+    bump_version('tickers')
+    send_event('tickers', 'tickers.updated')
+    return len(markets)
@@ -1,6 +1,6 @@
 import ccxt.pro
+import ccxt.async_support
 import structlog
-from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
 
 from accountant.methods import dt_aware_now, datetime_directive_ISO_8601
@@ -8,6 +8,9 @@ from accountant.models import TimestampedModel
 
 log = structlog.get_logger(__name__)
 
+# Open price of markets, keyed by (market pk, datetime)
+_open_prices = dict()
+
 
 class Exchange(TimestampedModel):
 
@@ -68,6 +71,27 @@ class Exchange(TimestampedModel):
 
         return client
 
+    def get_ccxt_client_async(self, account=None, wallet=None):
+
+        client = getattr(ccxt.async_support, self.exid)
+        client = client({
+            'verbose': self.verbose,
+            'adjustForTimeDifference': True,
+            'enableRateLimit': True,
+        })
+
+        if account:
+            client.secret = account.api_secret
+            client.apiKey = account.api_key
+            if 'password' in client.requiredCredentials:
+                client.password = account.password
+
+        if wallet:
+            if 'defaultType' in client.options:
+                client.options['defaultType'] = wallet
+
+        return client
+
     def get_ccxt_client_pro(self, args=None):
 
         client = getattr(ccxt.pro, self.exid)
@@ -140,23 +164,37 @@ class Market(TimestampedModel):
     def __str__(self):
         return self.symbol + '_' + self.type[:4] + '_' + self.exchange.exid[:3]
 
+    def get_price(self, dt=None):
+        """
+        Return Price object at dt or the latest one, in a single indexed query
+        """
+        qs = Price.objects.filter(market=self)
+        if dt:
+            return qs.filter(dt=dt).first()
+        return qs.order_by('-dt').first()
+
     def is_updated(self):
-        qs = Price.objects.filter(market=self).order_by('-dt')
-        if qs.exists():
-            last = qs.first()
-            if last.dt == dt_aware_now():
-                return True
-        return False
+        return Price.objects.filter(market=self, dt=dt_aware_now()).exists()
 
     def get_open_price(self):
-        qs = Price.objects.filter(market=self).order_by('-dt')
-        if qs.exists():
-            try:
-                return qs.get(dt=dt_aware_now()).last
-            except ObjectDoesNotExist:
+        """
+        Return today open price, the lookup is done once per market and day
+        """
+        dt = dt_aware_now()
+        if (self.pk, dt) not in _open_prices:
+
+            price = self.get_price(dt)
+            if not price:
                 log.error('Open price is not updated')
-        else:
-            log.error('Open price object not found')
+                return
+
+            # Forget previous days
+            for key in [k for k in _open_prices.keys() if k[1] != dt]:
+                del _open_prices[key]
+
+            _open_prices[(self.pk, dt)] = price.last
+
+        return _open_prices[(self.pk, dt)]
 
 
 class Price(TimestampedModel):
@@ -167,6 +205,7 @@ class Price(TimestampedModel):
 
     class Meta:
         verbose_name_plural = "Prices"
+        unique_together = ('market', 'dt',)
 
     def save(self, *args, **kwargs):
         return super(Price, self).save(*args, **kwargs)
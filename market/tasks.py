@@ -12,13 +12,16 @@ import structlog
 from billiard.process import current_process
 from django.db.utils import OperationalError
 from django.core.exceptions import ObjectDoesNotExist, SynchronousOnlyOperation
-from django.db import close_old_connections
+from django.db import transaction
+from django.conf import settings
 from celery import Task
 from accountant.settings import EXCHANGES, CODES
-from accountant.methods import dt_aware_now, datetime_directive_ISO_8601
 from accountant.celery import app
-from market.models import Exchange, Market, Currency, Price
-from market.methods import get_market, save_ticker_price
+from market.models import Exchange, Market, Currency
+from market.methods import get_market, flush_tickers, clear_markets_cache
+from market.clients import ClientRegistry
+from market.cache import get_ticker_cache
+from market.writer import DatabaseWriter
 import celery
 
 logger = structlog.get_logger(__name__)
@@ -71,20 +74,8 @@ def ws_loops(self):
 
                         # log.info(response['last'], symbol=response['symbol'])
 
-                        # Save ticker price every 5 sec.
-                        save_ticker_price(market, response, freq=5)
-
-                        if not market.is_updated():
-                            log = log.bind(dt=dt_aware_now().strftime(datetime_directive_ISO_8601),
-                                           market=market.type,
-                                           last=response['last'])
-
-                            Price.objects.create(market=market,
-                                                 response=response,
-                                                 dt=dt_aware_now(),
-                                                 last=response['last']
-                                                 )
-                            log.info('Price object created')
+                        # Keep the latest ticker in cache, it's flushed to database by flush_loop()
+                        cache.set(market.pk, response)
 
                     await asyncio.sleep(2)
 
@@ -92,7 +83,7 @@ def ws_loops(self):
                     log.error('Stream disconnection', cause=str(e), method=method)
 
                     log.info('Close connections')
-                    loop.close()
+                    await registry.close()
 
                     log.info('Retry task...')
                     raise self.retry(exc=e, countdown=5)
@@ -101,31 +92,38 @@ def ws_loops(self):
                     log.error('Stream disconnection', cause=str(e))
                     break
 
-            await client.close()
-
         async def clients_loop(loop, dic):
 
             exid, wallet, method, args = dic.values()
 
-            # Initialize exchange CCXT instance
-            exchange = Exchange.objects.get(exid=exid)
-            client = getattr(ccxt.pro, exchange.exid)
-            client = client(dict(enableRateLimit=True,
-                                 asyncio_loop=loop,
-                                 newUpdates=True
-                                 ))
+            # Select the CCXT instance shared by streams of the same exchange and wallet, a client that can't
+            # be created only ends its own streams
+            try:
+                client = await registry.acquire(exid, wallet)
+            except Exception as e:
+                log.error('Client creation failure', exid=exid, wallet=wallet, method=method, cause=str(e))
+                return
 
-            if wallet:
-                if 'defaultType' in client.options:
-                    client.options['defaultType'] = wallet
+            try:
+                await asyncio.gather(method_loop(client, exid, wallet, method, args))
+            finally:
+                await registry.release(exid, wallet)
 
-            # Close PostgreSQL connections
-            close_old_connections()
+        async def flush_loop(writer):
 
-            await asyncio.gather(method_loop(client, exid, wallet, method, args))
-            await client.close()
+            while True:
+                await asyncio.sleep(settings.TICKER_FLUSH_INTERVAL)
 
-        async def main(loop):
+                # Writes are queued, network reads never wait for the database
+                await writer.submit(flush_tickers, cache)
+
+        async def stats_loop(writer):
+
+            while True:
+                await asyncio.sleep(settings.DATABASE_WRITER_STATS_INTERVAL)
+                log.info('Database writer', **writer.stats())
+
+        def select_markets():
 
             lst = []
             exchanges = EXCHANGES.keys()
@@ -153,21 +151,39 @@ def ws_loops(self):
                                                       )
                                             )
                                        )
+            return lst
 
-            # Close PostgreSQL connections
-            close_old_connections()
+        async def main(loop):
 
-            loops = [clients_loop(loop, dic) for dic in lst]
+            writer = DatabaseWriter(maxsize=settings.DATABASE_WRITER_QUEUE_SIZE)
+            tasks = [asyncio.ensure_future(coroutine) for coroutine in [writer.run(),
+                                                                          flush_loop(writer),
+                                                                          stats_loop(writer)]]
 
             try:
+                lst = await writer.call(select_markets)
+                loops = [clients_loop(loop, dic) for dic in lst]
                 await asyncio.gather(*loops)
 
             except Exception as e:
                 log.exception(str(e))
             else:
                 pass
+            finally:
+                await writer.submit(flush_tickers, cache)
+                await writer.join()
+                log.info('Database writer', **writer.stats())
+
+                for task in tasks:
+                    task.cancel()
+
+                await writer.close()
+                await registry.close()
 
         loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        registry = ClientRegistry(loop)
+        cache = get_ticker_cache()
         loop.run_until_complete(main(loop))
 
     except SynchronousOnlyOperation as e:
@@ -183,7 +199,7 @@ def ws_loops(self):
 @app.task(name='Markets_____Update_exchange_currencies')
 def bulk_update_currencies():
     for exid in EXCHANGES.keys():
-        update_currencies.delay(exid)
+        update_currencies.delay(exid, refresh_markets=True)
 
 
 @app.task(name='Markets_____Update_exchange_markets')
@@ -234,9 +250,9 @@ def update_status(exid):
 
 
 @app.task(base=BaseTaskWithRetry)
-def update_currencies(exid):
+def update_currencies(exid, refresh_markets=False):
     """
-    Fetch currencies listed in the exchange and create/delete Currency
+    Fetch currencies listed in the exchange and create/update Currency, return the number of rows changed
     """
 
     log = logger.bind(exid=exid)
@@ -247,53 +263,57 @@ def update_currencies(exid):
         exchange = Exchange.objects.get(exid=exid)
         client = exchange.get_ccxt_client()
 
-        def update(code, dic):
+        # Currencies don't depend on the wallet, load them once
+        if exchange.wallets and exid != 'okex':
+            client.options['defaultType'] = exchange.get_wallets()[-1]
 
-            try:
-                obj = Currency.objects.get(code=code, exchange=exchange)
+        try:
+            client.load_markets(True)
 
-            # Currency isn't listed on the exchange
-            except ObjectDoesNotExist:
-                try:
-                    obj = Currency.objects.get(code=code)
+        except Exception as e:
+            raise Exception('Currencies update failure: {0}'.format(e))
 
-                # Currency isn't in database
-                except ObjectDoesNotExist:
+        currencies = {code: dic for code, dic in client.currencies.items()
+                      if code in CODES[exid]['supported_quote'] or code in CODES[exid]['supported_base']}
 
-                    log.info('Create new currency {0}'.format(code))
-                    obj = Currency.objects.create(code=code)
+        # Select currencies in database and currencies listed on the exchange
+        through = Currency.exchange.through
+        existing = {c.code: c for c in Currency.objects.filter(code__in=list(currencies.keys()))}
+        listed = set(through.objects.filter(exchange=exchange,
+                                            currency__code__in=list(currencies.keys())
+                                            ).values_list('currency_id', flat=True))
 
-            # Declare the currency as listed on the exchange
-            obj.exchange.add(exchange)
-            obj.response[exid] = dic
-            obj.save()
+        created = [Currency(code=code, response={exid: dic}) for code, dic in currencies.items()
+                   if code not in existing]
 
-            log.info('{0} is now listed in {1}'.format(code, exchange.name))
+        updated = []
+        for code, obj in existing.items():
+            if obj.response.get(exid) != currencies[code]:
+                obj.response[exid] = currencies[code]
+                updated.append(obj)
 
-        if exchange.wallets and exid != 'okex':
+        with transaction.atomic():
+            Currency.objects.bulk_create(created)
+            Currency.objects.bulk_update(updated, ['response'])
 
-            for wallet in exchange.get_wallets():
-                try:
-                    client.options['defaultType'] = wallet
-                    client.load_markets(True)
+            # Declare currencies as listed on the exchange
+            unlisted = [obj for obj in created + list(existing.values()) if obj.pk not in listed]
+            relations = [through(currency_id=obj.pk, exchange_id=exchange.pk) for obj in unlisted]
+            through.objects.bulk_create(relations, ignore_conflicts=True)
 
-                except Exception as e:
-                    raise Exception('Currencies update failure: {0}'.format(e))
+        for obj in created:
+            log.info('Create new currency {0}'.format(obj.code))
+        for obj in unlisted:
+            log.info('{0} is now listed in {1}'.format(obj.code, exchange.name))
 
-            else:
-                for code, dic in client.currencies.items():
-                    if code in CODES[exid]['supported_quote'] or \
-                            code in CODES[exid]['supported_base']:
-                        update(code, dic)
+        changed = len(created) + len(updated) + len(relations)
+        log.info('Task complete', exid=exid, created=len(created), updated=len(updated), listed=len(relations))
 
-        else:
-            client.load_markets(True)
-            for code, dic in client.currencies.items():
-                if code in CODES[exid]['supported_quote'] or \
-                        code in CODES[exid]['supported_base']:
-                    update(code, dic)
+        # Markets depend on currencies, refresh them only if something moved
+        if refresh_markets and changed:
+            update_markets.delay(exid)
 
-        log.info('Task complete', exid=exid)
+        return changed
 
     except ObjectDoesNotExist:
         log.error('Exchange is not created')
@@ -314,79 +334,113 @@ def update_markets(exid):
 
         exchange = Exchange.objects.get(exid=exid)
 
-        def update():
+        # Preload currencies listed on the exchange
+        currencies = {c.code: c for c in Currency.objects.filter(exchange=exchange)}
 
+        def select_values(market, response):
+            """
+            Return field values of a supported market, None otherwise
+            """
             base, quote = response['base'], response['quote']
 
             if quote in CODES[exid]['supported_quote'] and \
                     base in CODES[exid]['supported_base']:
 
-                try:
-                    Currency.objects.get(exchange=exchange, code=base)
-                    Currency.objects.get(exchange=exchange, code=quote)
-
                 # Abort if a currency is unknown
-                except ObjectDoesNotExist:
+                if base not in currencies or quote not in currencies:
                     log.warning('A currency is not supported for market {0}'.format(market))
                     return
 
+                tp = response['type'] if 'type' in response else None
+                swap = response['swap'] if 'swap' in response else None
+                spot = response['spot'] if 'spot' in response else None
+                option = response['option'] if 'option' in response else None
+                delivery = response['delivery'] if 'delivery' in response else None
+
+                if swap:
+                    tp = 'perpetual'
+                elif delivery:
+                    tp = 'delivery'
+                elif option:
+                    return
+
+                # Exchange specific
+                if exid == 'binance' and swap:
+                    if response['info']['contractType'] != 'PERPETUAL':
+                        tp = 'delivery'
+                if exid == 'ftx' and tp == 'future':
+                        tp = 'delivery'
+
+                # Abort is delivery
+                if tp == 'delivery':
+                    return
+
+                if spot:
+                    margined = None
+                elif response['settle'] in currencies:
+                    margined = currencies[response['settle']].pk
                 else:
+                    log.warning('Settlement currency is not supported for market {0}'.format(market))
+                    return
 
-                    if quote in CODES[exid]['supported_quote']:
-
-                        tp = response['type'] if 'type' in response else None
-                        swap = response['swap'] if 'swap' in response else None
-                        spot = response['spot'] if 'spot' in response else None
-                        option = response['option'] if 'option' in response else None
-                        delivery = response['delivery'] if 'delivery' in response else None
-
-                        if swap:
-                            tp = 'perpetual'
-                        elif delivery:
-                            tp = 'delivery'
-                        elif option:
-                            return
-
-                        # Exchange specific
-                        if exid == 'binance' and swap:
-                            if response['info']['contractType'] != 'PERPETUAL':
-                                tp = 'delivery'
-                        if exid == 'ftx' and tp == 'future':
-                                tp = 'delivery'
-
-                        # Abort is delivery
-                        if tp == 'delivery':
-                            return
-
-                        if spot:
-                            margined = None
-                        else:
-                            margined = Currency.objects.get(exchange=exchange, code=response['settle'])
-
-                        defaults = {
-                            'type': tp,
-                            'instrument': response['id'],
-                            'quote': Currency.objects.get(exchange=exchange, code=quote),
-                            'base': Currency.objects.get(exchange=exchange, code=base),
-                            'margined': margined,
-                            'margin': response['margin'],
-                            'active': response['active'],
-                            'contract_size': response['contractSize'],
-                            'taker': response['taker'],
-                            'maker': response['maker'],
-                            'limits': response['limits'],
-                            'precision': response['precision'],
-                            'info': response
-                        }
-
-                        # create or update market object
-                        obj, created = Market.objects.update_or_create(exchange=exchange,
-                                                                       wallet=wallet,
-                                                                       symbol=response['symbol'],
-                                                                       defaults=defaults
-                                                                       )
-                        if created:
-                            log.info('Create new market {0} {1}'.format(tp, response['symbol']))
+                return {
+                    'type': tp,
+                    'instrument': response['id'],
+                    'quote_id': currencies[quote].pk,
+                    'base_id': currencies[base].pk,
+                    'margined_id': margined,
+                    'margin': response['margin'],
+                    'active': response['active'],
+                    'contract_size': response['contractSize'],
+                    'taker': response['taker'],
+                    'maker': response['maker'],
+                    'limits': response['limits'],
+                    'precision': response['precision'],
+                    'info': response
+                }
+
+        def update(wallet, markets, unlisted):
+            """
+            Create new markets, update changed markets and delete unlisted markets in a single transaction
+            """
+            existing = {m.symbol: m for m in Market.objects.filter(exchange=exchange, wallet=wallet)}
+            created, updated, fields = [], [], set()
+
+            for market, response in markets.items():
+
+                values = select_values(market, response)
+                if not values:
+                    continue
+
+                if response['symbol'] in existing:
+                    obj = existing[response['symbol']]
+                    changed = [k for k, v in values.items() if getattr(obj, k) != v]
+                    if changed:
+                        for k in changed:
+                            setattr(obj, k, values[k])
+                            fields.add(k[:-3] if k.endswith('_id') else k)
+                        updated.append(obj)
+
+                else:
+                    created.append(Market(exchange=exchange,
+                                          wallet=wallet,
+                                          symbol=response['symbol'],
+                                          **values))
+
+            with transaction.atomic():
+                Market.objects.bulk_create(created, batch_size=500)
+                if updated:
+                    Market.objects.bulk_update(updated, sorted(fields), batch_size=500)
+
+                unlisted = unlisted.exclude(symbol__in=list(markets.keys()))
+                n = unlisted.count()
+                if n:
+                    unlisted.delete()
+
+            for obj in created:
+                log.info('Create new market {0} {1}'.format(obj.type, obj.symbol))
+
+            log.info('Markets updated', created=len(created), updated=len(updated), unlisted=n)
 
         if exchange.is_ok():
             client = exchange.get_ccxt_client()
@@ -402,28 +456,15 @@ def update_markets(exid):
 
                     else:
                         log.info('Update {0} {1} markets'.format(exchange.name, wallet))
-                        for market, response in client.markets.items():
-                            update()
-
-                        unlisted = Market.objects.filter(exchange=exchange, wallet=wallet).exclude(
-                            symbol__in=list(client.markets.keys())
-                        )
-                        if unlisted:
-                            log.info('Unlist {0} market(s)'.format(unlisted.count()))
-                            unlisted.delete()
+                        update(wallet, client.markets, Market.objects.filter(exchange=exchange, wallet=wallet))
 
             else:
-                wallet = None
                 log.info('Update {0} markets'.format(exchange.name))
 
                 client.load_markets(True)
-                for market, response in client.markets.items():
-                    update()
+                update(None, client.markets, Market.objects.filter(exchange=exchange))
 
-                unlisted = Market.objects.filter(exchange=exchange).exclude(symbol__in=list(client.markets.keys()))
-                if unlisted:
-                    log.info('Unlist {0} market(s)'.format(unlisted.count()))
-                    unlisted.delete()
+            clear_markets_cache(exchange)
 
         log.info('Task complete', exid=exid)
 
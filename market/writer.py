@@ -0,0 +1,87 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from django.db import close_old_connections, connections
+import structlog
+
+log = structlog.get_logger(__name__)
+
+
+class DatabaseWriter:
+    """
+    Run database operations of coroutines in a dedicated thread fed by a bounded queue
+    """
+
+    def __init__(self, maxsize=100):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='database_writer')
+        self.processed = 0
+        self.failed = 0
+        self.latency = 0
+        self.latency_max = 0
+        self.latency_total = 0
+
+    @staticmethod
+    def execute(fn, *args, **kwargs):
+        close_old_connections()
+        return fn(*args, **kwargs)
+
+    async def submit(self, fn, *args, **kwargs):
+        """
+        Queue a write and return immediately, wait for a free slot if the queue is full
+        """
+        if self.queue.full():
+            log.warning('Database writer queue is full', depth=self.queue.qsize())
+        await self.queue.put((fn, args, kwargs))
+
+    async def call(self, fn, *args, **kwargs):
+        """
+        Run a read in the writer thread and return its result
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(self.execute, fn, *args, **kwargs))
+
+    async def run(self):
+        """
+        Drain the queue, one write at a time
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            fn, args, kwargs = await self.queue.get()
+            start = time.monotonic()
+            try:
+                await loop.run_in_executor(self.executor, partial(self.execute, fn, *args, **kwargs))
+
+            except Exception as e:
+                self.failed += 1
+                log.error('Database write failure', method=fn.__name__, cause=str(e))
+
+            finally:
+                self.latency = time.monotonic() - start
+                self.latency_max = max(self.latency_max, self.latency)
+                self.latency_total += self.latency
+                self.processed += 1
+                self.queue.task_done()
+
+    async def join(self):
+        """
+        Wait until queued writes are executed
+        """
+        await self.queue.join()
+
+    async def close(self):
+        await self.call(connections.close_all)
+        self.executor.shutdown(wait=True)
+
+    def stats(self):
+        """
+        Return queue depth and write latency (ms) to monitor backpressure
+        """
+        return dict(depth=self.queue.qsize(),
+                    maxsize=self.queue.maxsize,
+                    processed=self.processed,
+                    failed=self.failed,
+                    latency=round(self.latency * 1000, 2),
+                    latency_avg=round(self.latency_total / self.processed * 1000, 2) if self.processed else 0,
+                    latency_max=round(self.latency_max * 1000, 2))
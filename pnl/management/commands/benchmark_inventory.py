@@ -0,0 +1,57 @@
+import time
+import numpy as np
+from django.core.management.base import BaseCommand
+from pnl import methods
+from pnl.methods import asset_entry, contract_entry, replay
+
+
+class Command(BaseCommand):
+    help = 'Compare the per-trade inventory loop with the vectorized replay on synthetic trades ' \
+           '(computation only, database writes are excluded)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--trades', type=int, default=1000000)
+        parser.add_argument('--instrument', type=int, default=0, choices=[0, 1])
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+
+        n, instrument = options['trades'], options['instrument']
+        rng = np.random.default_rng(options['seed'])
+
+        buy = rng.random(n) < (0.6 if instrument == 0 else 0.5)
+        amount = rng.uniform(0.001, 1, n)
+        price = rng.uniform(10000, 60000, n)
+        cost = amount * price
+
+        # Silence 'Non-inventoried asset sold' messages of the loop
+        logger, methods.log = methods.log, methods.log.bind()
+        methods.log.info = lambda *a, **kw: None
+
+        self.stdout.write('Replay {0} synthetic trades of instrument {1}'.format(n, instrument))
+
+        entry = asset_entry if instrument == 0 else contract_entry
+        sides = np.where(buy, 'buy', 'sell').tolist()
+        rows = list(zip(sides, amount.tolist(), cost.tolist(), price.tolist()))
+
+        start = time.perf_counter()
+        state, results = (0, 0, 0), []
+        for side, a, c, p in rows:
+            result = entry(*state, side, a, c, p)
+            state = result[:3]
+            results.append(result)
+        loop = time.perf_counter() - start
+
+        start = time.perf_counter()
+        columns = replay(buy, amount, cost, price, instrument)
+        vectorized = time.perf_counter() - start
+
+        methods.log = logger
+
+        expected = np.array([[np.nan if v is None else v for v in result] for result in results])
+        matches = np.isclose(np.column_stack(columns), expected, rtol=1e-6, atol=1e-6, equal_nan=True)
+
+        self.stdout.write('Loop        {0:.3f}s'.format(loop))
+        self.stdout.write('Vectorized  {0:.3f}s'.format(vectorized))
+        self.stdout.write('Speedup     {0:.1f}x'.format(loop / vectorized))
+        self.stdout.write('Mismatches  {0}'.format(int((~matches).any(axis=1).sum())))
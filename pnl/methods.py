@@ -0,0 +1,194 @@
+import numpy as np
+import structlog
+
+log = structlog.get_logger(__name__)
+
+
+def asset_entry(stock, total_cost, average_cost, side, amount, cost, price):
+    """
+    Return stock, total cost, average cost, realized and unrealized PnL of an asset after a trade
+    """
+    realized_pnl, unrealized_pnl = None, None
+
+    if side == 'buy':
+        stock = stock + amount
+        total_cost = total_cost + cost
+        average_cost = total_cost / stock
+
+    elif side == 'sell':
+        if amount > stock:
+            log.info('Non-inventoried asset sold')
+            stock = 0
+            total_cost = 0
+        else:
+            stock = stock - amount
+            total_cost = stock * average_cost
+
+        # Calculate realized PnL
+
+        purchase_price = average_cost
+        purchase_cost = amount * purchase_price  # cost of the asset
+        proceed = cost  # cash received from the sale of asset
+        realized_pnl = proceed - purchase_cost
+
+        # Calculate unrealized PnL
+
+        stock_value_current_price = stock * price  # stock value at the current price
+        stock_value_purchase_price = stock * purchase_price
+        unrealized_pnl = stock_value_current_price - stock_value_purchase_price
+
+    return stock, total_cost, average_cost, realized_pnl, unrealized_pnl
+
+
+def contract_entry(stock, total_cost, average_cost, side, amount, cost, price):
+    """
+    Return stock, total cost, average cost, realized and unrealized PnL of a contract after a trade
+    """
+    realized_pnl, unrealized_pnl = None, None
+
+    if side == 'buy':
+
+        # Close short
+        if stock < 0:
+
+            stock = stock + amount
+            total_cost = stock * average_cost  # decrease
+
+            # Determine realized and unrealized profit and loss for USDⓈ-margined contracts
+            # https://www.binance.com/en/support/faq/3a55a23768cb416fb404f06ffedde4b2
+
+            # Directives
+            exit_price = price
+            mark_price = price
+            entry_price = average_cost
+
+            realized_pnl_base = ((1 / entry_price) - (1 / exit_price)) * (cost * -1)
+            realized_pnl = realized_pnl_base * exit_price
+            unrealized_pnl = amount * -1 * (mark_price - entry_price)
+
+        # Open long
+        else:
+
+            stock = stock + amount
+            total_cost = total_cost + cost  # increase
+            average_cost = total_cost / stock
+
+            # No PnL calculation
+
+    elif side == 'sell':
+
+        # Open short
+        if stock <= 0:
+
+            stock = stock - amount  # allow negative stock to distinguish open and close
+            total_cost = total_cost + cost  # increase
+            average_cost = total_cost / abs(stock)
+
+            # No PnL calculation
+
+        # Close long
+        else:
+
+            stock = stock - amount
+            total_cost = stock * average_cost  # decrease
+
+            # Determine realized and unrealized profit and loss for USDⓈ-margined contracts
+            # https://www.binance.com/en/support/faq/3a55a23768cb416fb404f06ffedde4b2
+
+            # Directives
+            exit_price = price
+            mark_price = price
+            entry_price = average_cost
+
+            realized_pnl_base = ((1 / entry_price) - (1 / exit_price)) * cost
+            realized_pnl = realized_pnl_base * exit_price
+            unrealized_pnl = amount * 1 * (mark_price - entry_price)
+
+    return stock, total_cost, average_cost, realized_pnl, unrealized_pnl
+
+
+def linear_recurrence(a, b, x0, block=4096):
+    """
+    Return x with x[i] = a[i] * x[i - 1] + b[i] and x[-1] = x0, computed by blocks of cumulative products
+    """
+    x = np.empty(len(b))
+    start = 0
+    while start < len(b):
+        end = min(start + block, len(b))
+        a_, b_ = a[start:end], b[start:end]
+
+        # A zero coefficient resets the recurrence, prepend x0 as a reset
+        reset = np.concatenate(([True], a_ == 0))
+        q = np.cumprod(np.concatenate(([1.], np.where(a_ == 0, 1., a_))))
+
+        with np.errstate(all='ignore'):
+            s = np.cumsum(np.concatenate(([x0], b_)) / q)
+            seg = np.cumsum(reset) - 1
+            before = np.concatenate(([0.], s))[np.flatnonzero(reset)]
+            x_ = (q * (s - before[seg]))[1:]
+
+        if np.all(np.isfinite(x_)) and np.abs(q).min() > 1e-200:
+            x[start:end] = x_
+            start = end
+
+        # Products underflow, retry with a smaller block or loop
+        elif block > 64:
+            x[start:] = linear_recurrence(a[start:], b[start:], x0, block // 8)
+            return x
+
+        else:
+            for i in range(start, end):
+                x0 = a[i] * x0 + b[i]
+                x[i] = x0
+            start = end
+            continue
+
+        x0 = x[end - 1]
+
+    return x
+
+
+def replay(buy, amount, cost, price, instrument, stock=0., total_cost=0., average_cost=0.):
+    """
+    Return stock, total cost, average cost, realized and unrealized PnL arrays of a sequence of trades,
+    vectorized equivalent of asset_entry() and contract_entry() from an initial state
+    """
+    buy = np.asarray(buy, dtype=bool)
+    amount, cost, price = [np.asarray(v, dtype=float) for v in (amount, cost, price)]
+    signed = np.where(buy, amount, -amount)
+    cumulative = stock + np.cumsum(signed)
+
+    if instrument == 0:
+        # Stock can't be negative, a sell larger than the stock empties it
+        stocks = cumulative - np.minimum(0., np.minimum.accumulate(cumulative))
+    else:
+        stocks = cumulative
+
+    prev = np.concatenate(([stock], stocks[:-1]))
+    if instrument == 0:
+        opening = buy
+    else:
+        opening = (buy & (prev >= 0)) | (~buy & (prev <= 0))
+
+    # Total cost is average cost times absolute stock after an opening, stock after a closing
+    with np.errstate(all='ignore'):
+        weight = np.where(opening, np.abs(stocks), stocks)
+        a = np.where(opening, np.concatenate(([0.], weight[:-1])) / np.abs(stocks), 1.)
+        b = np.where(opening, cost / np.abs(stocks), 0.)
+
+        # First trade starts from the initial total cost
+        a[0] = 0.
+        b[0] = (total_cost + cost[0]) / abs(stocks[0]) if opening[0] else average_cost
+
+        averages = linear_recurrence(a, b, average_cost)
+        totals = averages * weight
+
+        if instrument == 0:
+            realized = np.where(buy, np.nan, cost - amount * averages)
+            unrealized = np.where(buy, np.nan, stocks * price - stocks * averages)
+        else:
+            direction = np.where(buy, -1., 1.)
+            realized = np.where(opening, np.nan, ((1 / averages) - (1 / price)) * cost * direction * price)
+            unrealized = np.where(opening, np.nan, amount * direction * (price - averages))
+
+    return stocks, totals, averages, realized, unrealized
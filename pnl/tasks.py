@@ -3,9 +3,15 @@ import structlog
 from billiard.process import current_process
 from account.models import Account, Trade
 from accountant.methods import datetime_directive_ISO_8601
+from accountant.cache import bump_account_version
 from accountant.celery import app
 from pnl.models import Inventory
+from pnl.methods import asset_entry, contract_entry, replay
+from django.conf import settings
+from django.db import transaction
 import logging
+import numpy as np
+import pandas as pd
 from celery.utils.log import get_task_logger
 from celery import group, chain
 
@@ -15,10 +21,10 @@ log = structlog.wrap_logger(get_task_logger(__name__))
 # log = get_task_logger(__name__)
 
 
-@app.task(bind=True, name='PnL_____Update_asset_inventory')
-def update_asset_inventory(self, pk):
+@app.task(bind=True, name='PnL_____Update_currency_inventory')
+def update_currency_inventory(self, pk, currency, instrument):
     """
-    Update asset inventory
+    Update inventory of a currency and instrument
     """
 
     account = Account.objects.get(pk=pk)
@@ -28,89 +34,93 @@ def update_asset_inventory(self, pk):
         pass
         # log = log.bind(worker=current_process().index, task=self.request.id[:3])
 
-    # Determine start datetime
-    entries = Inventory.objects.filter(account=account, instrument=0)
-    if entries.exists():
-        prev_entries = True
-        latest = entries.latest('datetime')
+    if instrument == Inventory.Type.ASSET:
+        entry, tp = asset_entry, 'spot'
+    else:
+        entry, tp = contract_entry, 'perpetual'
+
+    # Determine start datetime and running state from the latest entry of the currency
+    latest = Inventory.objects.filter(account=account,
+                                      currency_id=currency,
+                                      instrument=instrument
+                                      ).order_by('-datetime').first()
+    if latest:
         start_datetime = latest.datetime
+        state = (latest.stock or 0, latest.total_cost or 0, latest.average_cost or 0)
     else:
-        prev_entries = False
         start_datetime = account.dt_created
+        state = (0, 0, 0)
 
     # log = log.bind(start_datetime=start_datetime.strftime(datetime_directive_ISO_8601))
-    log.info('Update assets inventory')
+    log.info('Update inventory', currency=currency, instrument=instrument)
 
-    # Select trades and iterate
+    # Select trades and stream them
     trades = Trade.objects.filter(account=account,
-                                  order__market__type='spot',
+                                  order__market__type=tp,
+                                  order__market__base=currency,
                                   datetime__gt=start_datetime
-                                  ).order_by('dt_created')
-    if trades.exists():
-
-        for index, trade in enumerate(trades):
-
-            # log = log.bind(trade=trade.tradeid,
-            #                amount=trade.amount,
-            #                side=trade.side)
-
-            log.info('Create new entry')
-            entry = Inventory.objects.create(account=account,
-                                             exchange=account.exchange,
-                                             currency=trade.order.market.base,
-                                             trade=trade,
-                                             instrument=0,
-                                             datetime=trade.datetime)
-
-            # Determine stock, total and average costs from previous inventory entry
-            if prev_entries or index > 0:
-                prev = Inventory.objects.get(account=account, trade=trades[index - 1], instrument=0) if index > 0 \
-                    else latest
-                prev_stock = prev.stock
-                prev_total_cost = prev.total_cost
-                prev_average_cost = prev.average_cost
-
-            else:
-                prev_stock, prev_total_cost, prev_average_cost = [0 for i in range(3)]
-
-            # Determine stock, total and average costs
-
-            if trade.side == 'buy':
-                entry.stock = prev_stock + trade.amount
-                entry.total_cost = prev_total_cost + trade.cost
-                entry.average_cost = entry.total_cost / entry.stock
-
-            elif trade.side == 'sell':
-                if trade.amount > prev_stock:
-                    log.info('Non-inventoried asset sold')
-                    entry.stock = 0
-                    entry.total_cost = 0
-                else:
-                    entry.stock = prev_stock - trade.amount
-                    entry.total_cost = entry.stock * prev_average_cost
-
-                entry.average_cost = prev_average_cost
-
-                # Calculate realized PnL
+                                  ).order_by('dt_created').values_list('id', 'side', 'amount', 'cost', 'price',
+                                                                       'datetime', named=True)
+    entries, n = [], 0
+
+    with transaction.atomic():
+        for trade in trades.iterator(chunk_size=settings.INVENTORY_CHUNK_SIZE):
+
+            # Determine stock, total and average costs from the running state
+            stock, total_cost, average_cost, realized_pnl, unrealized_pnl = entry(*state,
+                                                                                  trade.side,
+                                                                                  trade.amount,
+                                                                                  trade.cost,
+                                                                                  trade.price)
+            state = (stock, total_cost, average_cost)
+
+            entries.append(Inventory(account=account,
+                                     exchange_id=account.exchange_id,
+                                     currency_id=currency,
+                                     trade_id=trade.id,
+                                     instrument=instrument,
+                                     stock=stock,
+                                     total_cost=total_cost,
+                                     average_cost=average_cost,
+                                     realized_pnl=realized_pnl,
+                                     unrealized_pnl=unrealized_pnl,
+                                     datetime=trade.datetime))
+
+            if len(entries) == settings.INVENTORY_CHUNK_SIZE:
+                Inventory.objects.bulk_create(entries)
+                n += len(entries)
+                entries = []
+
+        Inventory.objects.bulk_create(entries)
+        n += len(entries)
+
+    if not n:
+        log.info('Update inventory no required', currency=currency, instrument=instrument)
+        return
 
-                purchase_price = prev_average_cost
-                purchase_cost = trade.amount * purchase_price  # cost of the asset
-                proceed = trade.cost  # cash received from the sale of asset
-                entry.realized_pnl = proceed - purchase_cost
+    bump_account_version(pk)
+    log.info('Update inventory complete', currency=currency, instrument=instrument, entries=n)
 
-                # Calculate unrealized PnL
 
-                stock_value_current_price = entry.stock * trade.price  # stock value at the current price
-                stock_value_purchase_price = entry.stock * purchase_price
-                entry.unrealized_pnl = stock_value_current_price - stock_value_purchase_price
+def update_inventory_group(pk, instrument):
+    """
+    Update inventory of each traded currency in parallel, their running states are independent
+    """
+    tp = 'spot' if instrument == Inventory.Type.ASSET else 'perpetual'
+    currencies = Trade.objects.filter(account_id=pk,
+                                      order__market__type=tp
+                                      ).values_list('order__market__base', flat=True).distinct()
 
-            entry.save()
+    group(update_currency_inventory.si(pk, currency, instrument) for currency in currencies)()
 
-    else:
-        log.info('Update assets inventory no required')
-        return
 
-    log.info('Update assets inventory complete')
+@app.task(bind=True, name='PnL_____Update_asset_inventory')
+def update_asset_inventory(self, pk):
+    """
+    Update asset inventory
+    """
+    log.info('Update assets inventory')
+    update_inventory_group(pk, Inventory.Type.ASSET)
 
 
 @app.task(bind=True, name='PnL_____Update_contract_inventory')
@@ -118,131 +128,64 @@ def update_contract_inventory(self, pk):
     """
     Update contract inventory
     """
+    log.info('Update contracts inventory')
+    update_inventory_group(pk, Inventory.Type.CONTRACT)
 
-    account = Account.objects.get(pk=pk)
-    # log = logger.bind(account=account.name)
 
-    if self.request.id:
-        pass
-        # log = log.bind(worker=current_process().index, task=self.request.id[:3])
+@app.task(bind=True, name='PnL_____Rebuild_inventory')
+def rebuild_inventory(self, pk, instrument):
+    """
+    Delete and recompute inventory of an instrument with a vectorized replay of trades
+    """
 
-    # Determine start datetime
-    entries = Inventory.objects.filter(account=account, instrument=1)
-    if entries.exists():
-        prev_entries = True
-        latest = entries.latest('datetime')
-        start_datetime = latest.datetime
-    else:
-        prev_entries = False
-        start_datetime = account.dt_created
+    account = Account.objects.get(pk=pk)
+    tp = 'spot' if instrument == Inventory.Type.ASSET else 'perpetual'
 
-    # log_cont.bind(start_datetime=start_datetime.strftime(datetime_directive_ISO_8601))
-    # log_cont.info('Update contracts inventory')
+    log.info('Rebuild inventory', instrument=instrument)
 
-    # Select trades and iterate
+    # Load trades into columns
     trades = Trade.objects.filter(account=account,
-                                  order__market__type='perpetual',
-                                  datetime__gt=start_datetime
-                                  ).order_by('dt_created')
-    if trades.exists():
-
-        for index, trade in enumerate(trades):
-
-            # log = log.bind(trade=trade.tradeid,
-            #                amount=trade.amount,
-            #                side=trade.side)
-
-            log.info('Create new entry')
-            entry = Inventory.objects.create(account=account,
-                                             exchange=account.exchange,
-                                             currency=trade.order.market.base,
-                                             trade=trade,
-                                             instrument=1,
-                                             datetime=trade.datetime)
-
-            # Determine stock, total and average costs from previous inventory entry
-            if prev_entries or index > 0:
-                prev = Inventory.objects.get(account=account, trade=trades[index - 1], instrument=1) if index > 0 \
-                    else latest
-                prev_stock = prev.stock
-                prev_total_cost = prev.total_cost
-                prev_average_cost = prev.average_cost
-
-            else:
-                prev_stock, prev_total_cost, prev_average_cost = [0 for i in range(3)]
-
-            if trade.side == 'buy':
-
-                print(prev_stock, trade.amount, prev_total_cost, trade.cost)
-
-                # Close short
-                if prev_stock < 0:
-
-                    entry.stock = prev_stock + trade.amount
-                    entry.total_cost = entry.stock * prev_average_cost  # decrease
-                    entry.average_cost = prev_average_cost
-
-                    # entry.stock = str(entry.stock)
-                    # entry.total_cost = str(entry.total_cost)
-
-                    # Determine realized and unrealized profit and loss for USDⓈ-margined contracts
-                    # https://www.binance.com/en/support/faq/3a55a23768cb416fb404f06ffedde4b2
-
-                    # Directives
-                    exit_price = trade.price
-                    mark_price = trade.price
-                    entry_price = entry.average_cost
-
-                    realized_pnl_base = ((1 / entry_price) - (1 / exit_price)) * (trade.cost * -1)
-                    entry.realized_pnl = realized_pnl_base * exit_price
-                    entry.unrealized_pnl = trade.amount * -1 * (mark_price - entry_price)
-
-                # Open long
-                elif prev_stock >= 0:
-
-                    entry.stock = prev_stock + trade.amount
-                    entry.total_cost = prev_total_cost + trade.cost  # increase
-                    entry.average_cost = entry.total_cost / entry.stock
-
-                    # No PnL calculation
-
-            elif trade.side == 'sell':
-
-                # Open short
-                if prev_stock <= 0:
-
-                    entry.stock = prev_stock - trade.amount  # allow negative stock to distinguish open and close
-                    entry.total_cost = prev_total_cost + trade.cost  # increase
-                    entry.average_cost = entry.total_cost / abs(entry.stock)
-
-                    # No PnL calculation
-
-                # Close long
-                elif prev_stock > 0:
-
-                    entry.stock = prev_stock - trade.amount
-                    entry.total_cost = entry.stock * prev_average_cost  # decrease
-                    entry.average_cost = prev_average_cost
-
-                    # Determine realized and unrealized profit and loss for USDⓈ-margined contracts
-                    # https://www.binance.com/en/support/faq/3a55a23768cb416fb404f06ffedde4b2
-
-                    # Directives
-                    exit_price = trade.price
-                    mark_price = trade.price
-                    entry_price = entry.average_cost
-
-                    realized_pnl_base = ((1 / entry_price) - (1 / exit_price)) * trade.cost
-                    entry.realized_pnl = realized_pnl_base * exit_price
-                    entry.unrealized_pnl = trade.amount * 1 * (mark_price - entry_price)
-
-            entry.save()
-
-    else:
-        log.info('Update contracts inventory no required')
-        return
-
-    log.info('Update contracts inventory complete')
+                                  order__market__type=tp,
+                                  datetime__gt=account.dt_created,
+                                  side__in=['buy', 'sell']
+                                  ).order_by('dt_created').values_list('id', 'side', 'amount', 'cost', 'price',
+                                                                       'datetime', 'order__market__base')
+    df = pd.DataFrame.from_records(trades.iterator(chunk_size=settings.INVENTORY_CHUNK_SIZE),
+                                   columns=['id', 'side', 'amount', 'cost', 'price', 'datetime', 'currency'])
+
+    entries = []
+    for currency, trades in df.groupby('currency', sort=False):
+
+        columns = replay(trades['side'].eq('buy').values,
+                         trades['amount'].values,
+                         trades['cost'].values,
+                         trades['price'].values,
+                         instrument)
+
+        stock, total_cost, average_cost, realized_pnl, unrealized_pnl = [
+            [None if np.isnan(v) else v for v in column.tolist()] for column in columns
+        ]
+
+        entries += [Inventory(account=account,
+                              exchange_id=account.exchange_id,
+                              currency_id=currency,
+                              trade_id=trade_id,
+                              instrument=instrument,
+                              stock=stock[i],
+                              total_cost=total_cost[i],
+                              average_cost=average_cost[i],
+                              realized_pnl=realized_pnl[i],
+                              unrealized_pnl=unrealized_pnl[i],
+                              datetime=dt)
+                    for i, (trade_id, dt) in enumerate(zip(trades['id'].tolist(), trades['datetime'].tolist()))]
+
+    with transaction.atomic():
+        Inventory.objects.filter(account=account, instrument=instrument).delete()
+        Inventory.objects.bulk_create(entries, batch_size=settings.INVENTORY_CHUNK_SIZE)
+
+    bump_account_version(pk)
+
+    log.info('Rebuild inventory complete', instrument=instrument, entries=len(entries))
 
 
 @app.task(name='PnL_____Update_inventories')
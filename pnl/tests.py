@@ -1,3 +1,86 @@
-from django.test import TestCase
+from unittest import mock
+import numpy as np
+from django.test import SimpleTestCase
+from pnl import methods
+from pnl.methods import asset_entry, contract_entry, linear_recurrence, replay
 
-# Create your tests here.
+
+@mock.patch.object(methods, 'log', mock.Mock())
+class ReplayTestCase(SimpleTestCase):
+    """
+    Vectorized replay of trades must match the per-trade loop
+    """
+
+    def loop(self, buy, amount, cost, price, instrument, state=(0, 0, 0)):
+        entry = asset_entry if instrument == 0 else contract_entry
+        results = []
+        for b, a, c, p in zip(buy, amount, cost, price):
+            result = entry(*state, 'buy' if b else 'sell', a, c, p)
+            state = result[:3]
+            results.append([np.nan if v is None else v for v in result])
+        return np.array(results)
+
+    def assertReplayEqual(self, buy, amount, price, instrument, state=(0, 0, 0)):
+        buy, amount, price = np.asarray(buy), np.asarray(amount, dtype=float), np.asarray(price, dtype=float)
+        cost = amount * price
+        expected = self.loop(buy, amount, cost, price, instrument, state)
+        columns = np.column_stack(replay(buy, amount, cost, price, instrument, *state))
+        np.testing.assert_allclose(columns, expected, rtol=1e-6, atol=1e-6, equal_nan=True)
+
+    def test_asset(self):
+        rng = np.random.default_rng(0)
+        for n in [1, 2, 10, 500]:
+            self.assertReplayEqual(rng.random(n) < 0.6, rng.uniform(0.001, 1, n), rng.uniform(100, 200, n), 0)
+
+    def test_asset_oversold(self):
+        # Sells larger than the stock empty it
+        self.assertReplayEqual([True, False, False, True, False], [1, 2, 1, 3, 1], [10, 11, 12, 13, 14], 0)
+
+    def test_asset_from_state(self):
+        rng = np.random.default_rng(1)
+        n = 200
+        self.assertReplayEqual(rng.random(n) < 0.5, rng.uniform(0.001, 1, n), rng.uniform(100, 200, n), 0,
+                               state=(5., 750., 150.))
+
+    def test_contract_sign_flips(self):
+        rng = np.random.default_rng(2)
+        n = 2000
+        self.assertReplayEqual(rng.random(n) < 0.5, rng.choice([1., 2., 3.], n), rng.uniform(100, 200, n), 1)
+
+    def test_contract_from_state(self):
+        # Start short, flip long, close and flip short again
+        self.assertReplayEqual([True, True, False, False, True], [1, 3, 2, 3, 1], [10, 11, 12, 13, 14], 1,
+                               state=(-2., 20., 10.))
+
+    def test_fuzz(self):
+        rng = np.random.default_rng(3)
+        for _ in range(200):
+            n = int(rng.integers(1, 50))
+            instrument = int(rng.integers(0, 2))
+            stock = float(rng.choice([0., 1., -1.] if instrument else [0., 1.])) * rng.uniform(0.5, 3)
+            average = rng.uniform(100, 200) if stock else 0.
+            state = (stock, abs(stock) * average, average)
+            self.assertReplayEqual(rng.random(n) < 0.5, rng.choice([0.5, 1., 2.], n), rng.uniform(100, 200, n),
+                                   instrument, state=state)
+
+
+class LinearRecurrenceTestCase(SimpleTestCase):
+
+    def recurrence(self, a, b, x0):
+        x = []
+        for a_, b_ in zip(a, b):
+            x0 = a_ * x0 + b_
+            x.append(x0)
+        return np.array(x)
+
+    def test_blocks(self):
+        rng = np.random.default_rng(0)
+        a, b = rng.uniform(0.5, 1.5, 1000), rng.uniform(-1, 1, 1000)
+        a[rng.random(1000) < 0.05] = 0
+        for block in [7, 64, 4096]:
+            np.testing.assert_allclose(linear_recurrence(a, b, 2., block), self.recurrence(a, b, 2.), rtol=1e-9)
+
+    def test_underflow(self):
+        # Cumulative products underflow without resets
+        a, b = np.full(5000, 0.5), np.ones(5000)
+        np.testing.assert_allclose(linear_recurrence(a, b, 1.), self.recurrence(a, b, 1.), rtol=1e-9)